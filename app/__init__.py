@@ -25,6 +25,7 @@ TASKS: list[Callable] = [
     notifications.unread_chat_message_notifications,
     loadtesting.generate_loadtesting_configuration,
     beatmaps.fix_beatmap_total_lengths,
+    beatmaps.backfill_beatmap_lengths,
     beatmaps.recalculate_beatmap_difficulty,
     beatmaps.update_beatmap_statuses,
     stats.update_usercount_history,
@@ -39,11 +40,13 @@ TASKS: list[Callable] = [
     users.recreate_play_history_for_user,
     scores.recalculate_pp_status,
     scores.recalculate_score_status,
+    scores.recalculate_beatmap_statuses,
     scores.recalculate_score_statuses_all,
     scores.recalculate_rx_scores,
     ranks.update_ranks,
     ranks.index_ranks,
     ppv2.recalculate_ppv2_all_scores,
+    ppv2.recalculate_ppv2_incremental,
     ppv2.recalculate_ppv2_all_scores_multiprocessing,
     ppv2.recalculate_failed_ppv2_calculations,
     ppv2.recalculate_ppv2_multiprocessing,
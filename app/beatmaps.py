@@ -12,15 +12,23 @@ from app.common.database.repositories import (
     posts
 )
 
+from app.writers import BulkRowUpdater, BulkUpdater
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from typing import Tuple
+from itertools import batched, islice
+from app import processes, streaming
 from sqlalchemy.orm import Session
-from slider import Beatmap
+from array import array
 
+import operator
 import zipfile
 import stat
 import app
 import io
 
+DIFFICULTY_CHECKPOINT_KEY = 'bancho:jobs:beatmap_difficulty:checkpoint'
+
 def update_beatmap_statuses():
     """Update beatmap statuses (graveyard & qualified)"""
     with app.session.database.managed_session() as session:
@@ -65,56 +73,76 @@ def update_beatmap_statuses():
                 session=session
             )
 
-def recalculate_beatmap_difficulty():
+def recalculate_beatmap_difficulty(workers: int = 1, range_size: int = 1000, resume: bool = True):
     """Recalculate ppv2 difficulty for all beatmaps in the database"""
+    start_id = processes.load_checkpoint(DIFFICULTY_CHECKPOINT_KEY, resume)
+
     with app.session.database.managed_session() as session:
-        app.session.logger.info(
-            '[beatmaps] -> Recalculating beatmap difficulties'
-        )
-        current_offset = 0
+        beatmap_ranges = list(streaming.iterate_id_ranges(
+            session,
+            DBBeatmap.id,
+            range_size=int(range_size),
+            min_id=start_id
+        ))
 
-        while True:
-            pending_beatmaps = session.query(DBBeatmap) \
-                .offset(current_offset * 1000) \
-                .limit(1000) \
-                .all()
-                
-            if not pending_beatmaps:
-                break
+    app.session.logger.info(
+        f'[beatmaps] -> Recalculating beatmap difficulties '
+        f'({len(beatmap_ranges)} ranges, starting at {start_id}, {workers} workers)'
+    )
 
-            for beatmap in pending_beatmaps:
-                beatmap_file = app.session.beatmaps.osu(beatmap.id)
+    processes.process_ranges(
+        recalculate_beatmap_difficulty_range,
+        beatmap_ranges,
+        workers,
+        checkpoint_key=DIFFICULTY_CHECKPOINT_KEY,
+        name='beatmaps'
+    )
 
-                if not beatmap_file:
-                    app.session.logger.warning(
-                        f'[beatmaps] -> Beatmap file was not found! ({beatmap.id})'
-                    )
-                    continue
+    app.session.logger.info('[beatmaps] -> Done.')
 
-                try:
-                    result = performance.calculate_difficulty(
-                        beatmap_file,
-                        beatmap.mode
-                    )
-                except Exception as e:
-                    app.session.logger.warning(
-                        f'[beatmaps] -> Failed to calculate difficulty for beatmap {beatmap.id}',
-                        exc_info=e
-                    )
-                    continue
+def recalculate_beatmap_difficulty_range(beatmap_range: Tuple[int, int]) -> int:
+    min_id, max_id = beatmap_range
 
-                if not result:
-                    app.session.logger.warning(
-                        f'[beatmaps] -> Failed to calculate difficulty for beatmap {beatmap.id}'
-                    )
-                    continue
+    with app.session.database.managed_session() as session:
+        updater = BulkUpdater(session, DBBeatmap.diff)
+        beatmap_rows = session.query(DBBeatmap.id, DBBeatmap.mode) \
+            .filter(DBBeatmap.id >= min_id) \
+            .filter(DBBeatmap.id <= max_id) \
+            .order_by(DBBeatmap.id) \
+            .all()
+
+        for beatmap_id, mode in beatmap_rows:
+            beatmap_file = app.session.beatmaps.osu(beatmap_id)
 
-                session.query(DBBeatmap) \
-                    .filter(DBBeatmap.id == beatmap.id) \
-                    .update({'diff': result.star_rating})
-                session.flush()
+            if not beatmap_file:
+                app.session.logger.warning(
+                    f'[beatmaps] -> Beatmap file was not found! ({beatmap_id})'
+                )
+                continue
+
+            try:
+                result = performance.calculate_difficulty(
+                    beatmap_file,
+                    mode
+                )
+            except Exception as e:
+                app.session.logger.warning(
+                    f'[beatmaps] -> Failed to calculate difficulty for beatmap {beatmap_id}',
+                    exc_info=e
+                )
+                continue
+
+            if not result:
+                app.session.logger.warning(
+                    f'[beatmaps] -> Failed to calculate difficulty for beatmap {beatmap_id}'
+                )
+                continue
 
-            current_offset += 1
+            updater.add(beatmap_id, result.star_rating)
+
+        updater.flush()
+        session.commit()
+        return updater.total
 
 def handle_qualified_set(beatmapset: DBBeatmapset, session: Session):
     approved_time = datetime.now() - beatmapset.approved_at
@@ -341,44 +369,95 @@ def hide_scores(beatmapset: DBBeatmapset, session: Session) -> None:
 
 def fix_beatmap_total_lengths() -> None:
     """Fix total lengths for all beatmaps in the database"""
-    with app.session.database.managed_session() as session:
-        app.session.logger.info(
-            '[beatmaps] -> Fixing beatmap total lengths'
-        )
-        
-        affected_beatmaps = session.query(DBBeatmap) \
-            .filter(DBBeatmap.created_at >= datetime(2025, 10, 8)) \
-            .order_by(DBBeatmap.id) \
-            .all()
+    backfill_beatmap_lengths(since='2025-10-08')
+
+def backfill_beatmap_lengths(
+    min_id: int = 0,
+    max_id: int | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    workers: int = 1,
+    threads: int = 8,
+    batch_size: int = 500
+) -> None:
+    """Re-derive total & drain lengths for a range of beatmaps from their files"""
+    criteria = [DBBeatmap.id >= min_id]
 
-        app.session.logger.info(
-            f'[beatmaps] -> Found {len(affected_beatmaps)} beatmaps to update'
-        )
-            
-        for beatmap in affected_beatmaps:
-            if not (beatmap_file := app.session.storage.get_beatmap(beatmap.id)):
-                app.session.logger.warning(
-                    f'[beatmaps] -> Beatmap file was not found! ({beatmap.id})'
-                )
-                continue
+    if max_id:
+        criteria.append(DBBeatmap.id <= max_id)
+
+    if since:
+        criteria.append(DBBeatmap.created_at >= datetime.fromisoformat(since))
+
+    if until:
+        criteria.append(DBBeatmap.created_at < datetime.fromisoformat(until))
+
+    app.session.logger.info(
+        '[beatmaps] -> Fixing beatmap total lengths'
+    )
 
-            beatmap_object = Beatmap.parse(beatmap_file.decode("utf-8-sig"))
-            total_length = calculate_beatmap_total_length(beatmap_object)
-            drain_length = calculate_beatmap_drain_length(beatmap_object)
-
-            session.query(DBBeatmap) \
-                .filter(DBBeatmap.id == beatmap.id) \
-                .update({
-                    'total_length': round(total_length / 1000),
-                    'drain_length': round(drain_length / 1000)
-                })
-            session.flush()
-            
-            app.session.logger.info(
-                f'[beatmaps] -> Updated lengths for beatmap {beatmap.id} '
-                f'(Total: {round(total_length / 1000)}s, Drain: {round(drain_length / 1000)}s)'
+    process_pool = processes.create_pool(workers) if int(workers) > 1 else None
+    compute = process_pool.map if process_pool else map
+
+    try:
+        with app.session.database.managed_session() as session, \
+             app.session.database.managed_session() as write_session, \
+             ThreadPoolExecutor(max(1, int(threads))) as thread_pool:
+            # Stream the ids through a separate session, since
+            # committing would close the server-side cursor
+            beatmap_ids = session.query(DBBeatmap.id) \
+                .filter(*criteria) \
+                .order_by(DBBeatmap.id) \
+                .yield_per(batch_size)
+
+            updater = BulkRowUpdater(
+                write_session,
+                (DBBeatmap.id,),
+                (DBBeatmap.total_length, DBBeatmap.drain_length),
+                batch_size
             )
 
+            for batch in batched((beatmap_id for (beatmap_id,) in beatmap_ids), batch_size):
+                beatmap_files = list(thread_pool.map(app.session.storage.get_beatmap, batch))
+                found_beatmaps = [
+                    (beatmap_id, beatmap_file)
+                    for beatmap_id, beatmap_file in zip(batch, beatmap_files)
+                    if beatmap_file
+                ]
+
+                for beatmap_id in set(batch) - {beatmap_id for beatmap_id, _ in found_beatmaps}:
+                    app.session.logger.warning(
+                        f'[beatmaps] -> Beatmap file was not found! ({beatmap_id})'
+                    )
+
+                lengths = compute(
+                    calculate_beatmap_lengths,
+                    [beatmap_file for _, beatmap_file in found_beatmaps]
+                )
+
+                for (beatmap_id, _), (total_length, drain_length) in zip(found_beatmaps, lengths):
+                    updater.add(
+                        beatmap_id,
+                        round(total_length / 1000),
+                        round(drain_length / 1000)
+                    )
+
+                updater.flush()
+                write_session.commit()
+
+                app.session.logger.info(
+                    f'[beatmaps] -> Updated lengths for {updater.total} beatmaps (up to {batch[-1]})'
+                )
+    finally:
+        if process_pool:
+            process_pool.terminate()
+
+def calculate_beatmap_lengths(beatmap_file: bytes) -> Tuple[int, int]:
+    hit_object_times = scan_hit_object_times(beatmap_file)
+    total_length = calculate_beatmap_total_length(hit_object_times)
+    drain_length = calculate_beatmap_drain_length(hit_object_times)
+    return total_length, drain_length
+
 # The minimum gap between the start of the break and the previous object.
 gap_before_break = 200
 
@@ -391,42 +470,54 @@ min_break_duration = 650
 # The minimum required duration of a gap between two objects such that a break can be placed between them.
 minimum_gap = gap_before_break + min_break_duration + gap_after_break
 
-def calculate_beatmap_total_length(beatmap: Beatmap) -> int:
-    """Calculate the total length of a beatmap from its hit objects"""
-    hit_objects = beatmap.hit_objects()
+def scan_hit_object_times(beatmap_file: bytes) -> array:
+    """Read the start times of all hit objects, without parsing the rest of the beatmap"""
+    times = array('i')
+    section_start = beatmap_file.find(b'[HitObjects]')
 
-    if len(hit_objects) <= 1:
-        return 0
+    if section_start == -1:
+        return times
 
-    last_object = hit_objects[-1].time.total_seconds() * 1000
-    return last_object
+    for line in beatmap_file[section_start + 12:].splitlines():
+        line = line.strip()
 
-def calculate_beatmap_drain_length(beatmap: Beatmap) -> int:
-    """Calculate the drain length of a beatmap from its hit objects"""
-    hit_objects = beatmap.hit_objects()
+        if not line or line.startswith(b'//'):
+            continue
 
-    if len(hit_objects) <= 1:
-        return 0
+        if line.startswith(b'['):
+            # Reached the next section
+            break
 
-    # Identify every break in the beatmap
-    # and subtract it from the total length
-    last_object = hit_objects[-1].time.total_seconds() * 1000
-    first_object = hit_objects[0].time.total_seconds() * 1000
-    total_length = last_object - first_object
-    break_deltas = []
+        fields = line.split(b',', 3)
 
-    for index, hit_object in enumerate(hit_objects):
-        if index <= 0:
+        if len(fields) < 4:
             continue
 
-        previous_object = hit_objects[index - 1]
-        delta_time = hit_object.time - previous_object.time
-        delta_time_seconds = delta_time.total_seconds() * 1000
+        times.append(int(float(fields[2])))
 
-        if delta_time_seconds <= minimum_gap:
-            continue
+    return times
 
-        break_deltas.append(delta_time_seconds - (gap_before_break + gap_after_break))
+def calculate_beatmap_total_length(hit_object_times: array) -> int:
+    """Calculate the total length of a beatmap from its hit object times"""
+    if len(hit_object_times) <= 1:
+        return 0
 
-    total_break_time = sum(break_deltas)
+    return hit_object_times[-1]
+
+def calculate_beatmap_drain_length(hit_object_times: array) -> int:
+    """Calculate the drain length of a beatmap from its hit object times"""
+    if len(hit_object_times) <= 1:
+        return 0
+
+    # Identify every break in the beatmap
+    # and subtract it from the total length
+    total_length = hit_object_times[-1] - hit_object_times[0]
+    delta_times = map(operator.sub, islice(hit_object_times, 1, None), hit_object_times)
+    break_gap = gap_before_break + gap_after_break
+
+    total_break_time = sum(
+        delta_time - break_gap
+        for delta_time in delta_times
+        if delta_time > minimum_gap
+    )
     return max(total_length - total_break_time, 0)
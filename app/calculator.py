@@ -0,0 +1,79 @@
+
+from app.common.helpers.performance.ppv2_rosu import RosuPerformanceCalculator
+from app.common.helpers.beatmaps import BeatmapResources
+from importlib.metadata import version
+from contextlib import contextmanager
+from collections import OrderedDict
+from typing import Any, Iterator
+
+import threading
+
+# Increase this whenever the way pp is calculated changes,
+# to mark every previous calculation as outdated
+CALCULATOR_REVISION = 1
+CALCULATOR_VERSION = f'rosu-pp-py-{version("rosu-pp-py")}.{CALCULATOR_REVISION}'
+
+class CachedBeatmapResources:
+    """Beatmap resources, that can keep beatmap files in memory for the current thread"""
+
+    def __init__(self, resources: BeatmapResources, cache_size: int = 256) -> None:
+        self.resources = resources
+        self.cache_size = cache_size
+        self.local = threading.local()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.resources, name)
+
+    @property
+    def files(self) -> OrderedDict | None:
+        return getattr(self.local, 'files', None)
+
+    def osu(self, beatmap_id: int) -> bytes | None:
+        if (files := self.files) is None:
+            return self.resources.osu(beatmap_id)
+
+        if beatmap_id in files:
+            files.move_to_end(beatmap_id)
+            return files[beatmap_id]
+
+        files[beatmap_id] = self.resources.osu(beatmap_id)
+
+        if len(files) > self.cache_size:
+            files.popitem(last=False)
+
+        return files[beatmap_id]
+
+    @contextmanager
+    def cached(self) -> Iterator[None]:
+        """Keep the beatmap files loaded by this thread in memory, until the block completes"""
+        if self.files is not None:
+            # Nested blocks will share the outer cache
+            yield
+            return
+
+        self.local.files = OrderedDict()
+
+        try:
+            yield
+        finally:
+            self.local.files = None
+
+class CachedPerformanceCalculator(RosuPerformanceCalculator):
+    """Rosu calculator, which loads beatmap files through a task-scoped file cache"""
+
+    def __init__(self, resources: BeatmapResources, cache_size: int = 256) -> None:
+        # The calculation itself is left to the base class, so that
+        # mod handling & beatmap conversion stay in a single place
+        self.cached_resources = CachedBeatmapResources(resources, cache_size)
+        super().__init__(self.cached_resources)
+
+    @property
+    def version(self) -> str:
+        return CALCULATOR_VERSION
+
+    def beatmap_file(self, beatmap_id: int) -> bytes | None:
+        return self.cached_resources.osu(beatmap_id)
+
+    def cached(self) -> Iterator[None]:
+        """Cache beatmap files for the duration of a task, so that no stale files outlive it"""
+        return self.cached_resources.cached()
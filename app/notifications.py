@@ -1,58 +1,77 @@
 
-from app.common.database import messages, notifications, users
+from app.common.database.objects import DBDirectMessage, DBNotification, DBUser
 from app.common.constants import NotificationType
+from app.common.database import notifications
+from collections import defaultdict
 from sqlalchemy.orm import Session
-from typing import Tuple
+from typing import Dict, Tuple
+from sqlalchemy import func
 
 import app
 
 def unread_chat_message_notifications() -> None:
     """Generate unread chat message notifications for all users"""
     with app.session.database.managed_session() as session:
-        for user in users.fetch_all(session=session):
-            message, link = generate_unread_chat_notification(
-                user.id,
-                session
-            )
+        unread_messages = fetch_unread_dm_counts(session)
+
+        if not unread_messages:
+            return
+
+        # Delete old chat notifications to avoid spamming
+        session.query(DBNotification) \
+            .filter(DBNotification.user_id.in_(unread_messages.keys())) \
+            .filter(DBNotification.type == NotificationType.Chat) \
+            .delete(synchronize_session=False)
+
+        for user_id, unread_senders in unread_messages.items():
+            message, link = generate_unread_chat_notification(unread_senders)
 
             if not message:
                 continue
 
-            # Delete old chat notifications to avoid spamming
-            notifications.delete_by_type(
-                user.id,
-                NotificationType.Chat,
-                session=session
-            )
-
             # Create new notification
             notifications.create(
-                user.id,
+                user_id,
                 NotificationType.Chat,
                 "New Direct Messages",
                 message,
                 link=link,
                 session=session
             )
-            
-            app.session.logger.info(
-                f"[notifications] -> Created unread chat notification for {user.name}"
-            )
 
-def generate_unread_chat_notification(user_id: int, session: Session) -> Tuple[str, str]:
-    unread_messages = messages.fetch_dms_unread_count_all(user_id, session)
-    total_messages = sum(unread_messages.values())
+        app.session.logger.info(
+            f"[notifications] -> Created unread chat notifications for {len(unread_messages)} users"
+        )
+
+def fetch_unread_dm_counts(session: Session) -> Dict[int, Dict[int, Tuple[str, int]]]:
+    """Fetch the unread direct message counts of all users, grouped by target & sender"""
+    rows = session.query(
+        DBDirectMessage.target_id,
+        DBDirectMessage.sender_id,
+        DBUser.name,
+        func.count()
+    ) \
+        .join(DBUser, DBUser.id == DBDirectMessage.sender_id) \
+        .filter(DBDirectMessage.read == False) \
+        .group_by(DBDirectMessage.target_id, DBDirectMessage.sender_id, DBUser.name) \
+        .all()
+
+    unread_messages = defaultdict(dict)
+
+    for target_id, sender_id, sender_name, count in rows:
+        unread_messages[target_id][sender_id] = (sender_name, count)
+
+    return unread_messages
+
+def generate_unread_chat_notification(unread_senders: Dict[int, Tuple[str, int]]) -> Tuple[str, str]:
+    total_messages = sum(count for _, count in unread_senders.values())
 
     if total_messages <= 0:
         return "", ""
 
-    username_mapping = {
-        user_id: users.fetch_username(user_id, session)
-        for user_id in unread_messages.keys()
-    }
     usernames_sorted = sorted(
-        username_mapping.items(),
-        key=lambda item: unread_messages[item[0]],
+        ((sender_id, name) for sender_id, (name, _) in unread_senders.items()),
+        key=lambda item: unread_senders[item[0]][1],
         reverse=True
     )
     username_list = ', '.join(username for _, username in usernames_sorted)
@@ -0,0 +1,240 @@
+
+from contextlib import contextmanager
+from redis.client import Pipeline
+from typing import Iterator, List
+from redis import Redis
+
+import threading
+
+# Commands that will be queued up inside of a buffered block.
+# Any other command will flush the queue first, so that reads
+# are still able to see previously queued writes.
+BUFFERED_COMMANDS = frozenset({
+    'DEL', 'UNLINK', 'EXPIRE', 'SET', 'SETEX', 'MSET',
+    'INCR', 'INCRBY', 'INCRBYFLOAT', 'DECR', 'DECRBY',
+    'HSET', 'HMSET', 'HDEL', 'HINCRBY', 'HINCRBYFLOAT',
+    'SADD', 'SREM', 'LPUSH', 'RPUSH',
+    'ZADD', 'ZREM', 'ZINCRBY', 'ZREMRANGEBYSCORE', 'ZREMRANGEBYRANK'
+})
+
+# Commands that only take a single key as their first argument
+SINGLE_KEY_COMMANDS = frozenset({
+    'EXPIRE', 'SET', 'SETEX', 'GET', 'TTL', 'TYPE', 'STRLEN',
+    'INCR', 'INCRBY', 'INCRBYFLOAT', 'DECR', 'DECRBY',
+    'HSET', 'HMSET', 'HDEL', 'HGET', 'HMGET', 'HGETALL', 'HEXISTS',
+    'HLEN', 'HKEYS', 'HVALS', 'HINCRBY', 'HINCRBYFLOAT',
+    'SADD', 'SREM', 'SMEMBERS', 'SISMEMBER', 'SCARD',
+    'LPUSH', 'RPUSH', 'LRANGE', 'LLEN',
+    'ZADD', 'ZREM', 'ZINCRBY', 'ZREMRANGEBYSCORE', 'ZREMRANGEBYRANK',
+    'ZSCORE', 'ZMSCORE', 'ZRANK', 'ZREVRANK', 'ZCARD', 'ZCOUNT',
+    'ZRANGE', 'ZREVRANGE', 'ZRANGEBYSCORE', 'ZREVRANGEBYSCORE'
+})
+
+# Commands where every argument is a key
+MULTI_KEY_COMMANDS = frozenset({'DEL', 'UNLINK', 'EXISTS', 'MGET'})
+
+class PipelineWriter:
+    """Queues write commands into a pipeline, and sends them every N items"""
+
+    def __init__(self, pipeline: Pipeline, flush_every: int = 500) -> None:
+        self.pipeline = pipeline
+        self.flush_every = max(1, flush_every)
+        self.pending_items = 0
+
+    def checkpoint(self) -> None:
+        self.pending_items += 1
+
+        if self.pending_items >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        self.pipeline.execute()
+        self.pending_items = 0
+
+class BufferedRedis(Redis):
+    """Redis client, that can buffer write commands of the current thread into a pipeline"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.local = threading.local()
+
+    @property
+    def writer(self) -> PipelineWriter | None:
+        return getattr(self.local, 'writer', None)
+
+    @property
+    def shadow_prefix(self) -> str | None:
+        return getattr(self.local, 'shadow_prefix', None)
+
+    @property
+    def recorded_commands(self) -> List[tuple] | None:
+        return getattr(self.local, 'recorded_commands', None)
+
+    def execute_command(self, *args, **options):
+        if self.shadow_prefix is not None:
+            args = self.shadow_arguments(args)
+
+        if (recorded_commands := self.recorded_commands) is not None:
+            recorded_commands.append(args)
+
+        if (writer := self.writer) is None:
+            return super().execute_command(*args, **options)
+
+        if str(args[0]).upper() in BUFFERED_COMMANDS:
+            writer.pipeline.execute_command(*args, **options)
+            return None
+
+        writer.flush()
+        return super().execute_command(*args, **options)
+
+    @contextmanager
+    def buffered(self, flush_every: int = 500) -> Iterator[PipelineWriter]:
+        """Buffer all write commands issued by this thread inside of the block"""
+        if (writer := self.writer) is not None:
+            # Nested blocks will share the outer pipeline
+            yield writer
+            return
+
+        writer = PipelineWriter(
+            super().pipeline(transaction=False),
+            flush_every
+        )
+        self.local.writer = writer
+
+        try:
+            yield writer
+            writer.flush()
+        finally:
+            self.local.writer = None
+            writer.pipeline.reset()
+
+    @contextmanager
+    def recording(self) -> Iterator[List[tuple]]:
+        """Collect the arguments of all commands issued by this thread inside of the block"""
+        recorded_commands = []
+        self.local.recorded_commands = recorded_commands
+
+        try:
+            yield recorded_commands
+        finally:
+            self.local.recorded_commands = None
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> Pipeline:
+        if self.shadow_prefix is not None:
+            # Pipelines send their commands without going through
+            # execute_command, so their keys cannot be redirected
+            raise RuntimeError('Pipelines cannot be used inside of a shadowed block')
+
+        return super().pipeline(transaction, shard_hint)
+
+    @contextmanager
+    def shadowed(self, prefix: str = 'shadow:', replace_families: bool = False) -> Iterator[None]:
+        """Redirect all keys used by this thread into temporary keys, which atomically replace the live keys once the block completes"""
+        # Remove leftovers of previous, interrupted rebuilds
+        for key in self.scan_iter(match=f'{prefix}*', count=1000):
+            self.unlink(key)
+
+        self.local.shadow_prefix = prefix
+        self.local.shadow_keys = set()
+
+        try:
+            yield
+        except BaseException:
+            shadow_keys = self.local.shadow_keys
+            self.local.shadow_prefix = None
+            self.local.shadow_keys = None
+
+            if shadow_keys:
+                self.unlink(*shadow_keys)
+
+            raise
+
+        shadow_keys = self.local.shadow_keys
+        self.local.shadow_prefix = None
+        self.local.shadow_keys = None
+        self.swap_shadow_keys(prefix, shadow_keys, replace_families)
+
+    def shadow_arguments(self, args: tuple) -> tuple:
+        command = str(args[0]).upper()
+
+        if command in SINGLE_KEY_COMMANDS:
+            keys = [self.shadow_key(args[1])]
+            args = (args[0], keys[0], *args[2:])
+
+        elif command in MULTI_KEY_COMMANDS:
+            keys = [self.shadow_key(key) for key in args[1:]]
+            args = (args[0], *keys)
+
+        else:
+            # Any write to a key we don't know about would
+            # go straight to the live data, so refuse it
+            raise RuntimeError(f'Command "{command}" is not supported inside of a shadowed block')
+
+        if command in BUFFERED_COMMANDS:
+            # Only keys that were written to will be swapped
+            self.local.shadow_keys.update(keys)
+
+        return args
+
+    def shadow_key(self, key: str | bytes) -> str:
+        if isinstance(key, bytes):
+            key = key.decode()
+
+        return f'{self.shadow_prefix}{key}'
+
+    def swap_shadow_keys(self, prefix: str, shadow_keys: set[str], replace_families: bool = False) -> None:
+        shadow_keys = sorted(shadow_keys)
+        stale_keys = set()
+
+        with self.pipeline(transaction=False) as pipeline:
+            for key in shadow_keys:
+                pipeline.exists(key)
+
+            existing_keys = pipeline.execute()
+
+        if replace_families:
+            # Live keys that share a namespace with a rebuilt key (e.g. "a:b:*"
+            # for "a:b:c") but were not rebuilt themselves, are removed as well
+            live_keys = {key.removeprefix(prefix) for key in shadow_keys}
+            stale_keys = self.fetch_stale_keys(prefix, live_keys)
+
+        # Swap every key inside of a single MULTI/EXEC block, so
+        # that clients never get to see a partially rebuilt state
+        with self.pipeline(transaction=True) as pipeline:
+            for key, exists in zip(shadow_keys, existing_keys):
+                live_key = key.removeprefix(prefix)
+
+                if exists:
+                    pipeline.rename(key, live_key)
+                    continue
+
+                # The rebuilt set ended up being empty
+                pipeline.unlink(live_key)
+
+            if stale_keys:
+                # e.g. leaderboards of countries without any players left
+                pipeline.unlink(*stale_keys)
+
+            pipeline.execute()
+
+    def fetch_stale_keys(self, prefix: str, live_keys: set[str]) -> set[str]:
+        """Find live keys inside of the namespaces of the rebuilt keys, that were not rebuilt"""
+        # Top-level keys (e.g. "a:b") are skipped, to never
+        # match an entire namespace like "a:*"
+        families = {
+            f'{key.rsplit(":", 1)[0]}:*'
+            for key in live_keys
+            if key.count(':') >= 2
+        }
+        stale_keys = set()
+
+        for pattern in families:
+            for key in self.scan_iter(match=pattern, count=1000):
+                key = key.decode() if isinstance(key, bytes) else key
+
+                if key.startswith(prefix) or key in live_keys:
+                    continue
+
+                stale_keys.add(key)
+
+        return stale_keys
@@ -1,14 +1,15 @@
 from app.common.database import users, stats, scores, histories
-from app.common.database.objects import DBUser, DBScore
+from app.common.database.objects import DBUser, DBScore, DBStats
 from app.common.config import config_instance as config
 from app.common.helpers import performance
 from app.common.cache import leaderboards
 from sqlalchemy.orm import Session
-from typing import List
+from app.writers import BulkUpdater
+from typing import Tuple
+from app import processes
+from app import streaming
 
-import multiprocessing
 import app.session
-import os
 
 def update_ppv1() -> None:
     """Update ppv1 calculations for all users"""
@@ -19,6 +20,8 @@ def update_ppv1() -> None:
     with app.session.database.managed_session() as session:
         app.session.logger.info('[ppv1] -> Updating ppv1 calculations...')
 
+        # ppv1 depends on the scores of other players, so
+        # inactive players have to be recalculated as well
         user_list = users.fetch_all(session=session)
         user_list.sort(key=resolve_user_ppv1, reverse=True)
 
@@ -59,10 +62,11 @@ def update_ppv1_for_user(user: DBUser, session: Session) -> None:
         )
 
         # Update cache
-        leaderboards.update(
-            user_stats,
-            user.country
-        )
+        with app.session.redis.buffered():
+            leaderboards.update(
+                user_stats,
+                user.country
+            )
 
         if not config.FROZEN_RANK_UPDATES:
             # Update rank history
@@ -80,75 +84,83 @@ def update_ppv1_multiprocessing(workers: int = 10) -> None:
         app.session.logger.info('[ppv1] -> ppv1 updates are disabled, skipping...')
         return
 
-    with multiprocessing.Pool(workers) as pool:
-        with app.session.database.managed_session() as session:
-            app.session.logger.info(f'[ppv1] -> Updating ppv1 calculations ({workers} workers)...')
+    with app.session.database.managed_session() as session:
+        app.session.logger.info(f'[ppv1] -> Updating ppv1 calculations ({workers} workers)...')
+
+        # Only send user ids to the workers, they
+        # will load the user & stats by themselves
+        user_rows = session.query(DBUser.id) \
+            .outerjoin(DBStats, (DBStats.user_id == DBUser.id) & (DBStats.mode == 0)) \
+            .filter(DBUser.restricted == False) \
+            .order_by(DBStats.ppv1.desc().nulls_last(), DBUser.id) \
+            .all()
 
-            user_list = users.fetch_all(session=session)
-            user_list.sort(key=resolve_user_ppv1, reverse=True)
+        user_ids = [user_id for (user_id,) in user_rows]
 
-            # Adjust pool size
-            config.POSTGRES_POOL_SIZE = 1
-            config.POSTGRES_POOL_SIZE_OVERFLOW = -1
-            os.environ['POSTGRES_POOL_SIZE'] = '1'
-            os.environ['POSTGRES_POOL_SIZE_OVERFLOW'] = '-1'
+    with processes.create_pool(workers) as pool:
+        pool.map(
+            update_ppv1_for_user_id,
+            user_ids,
+            chunksize=1
+        )
 
-            pool.starmap(
-                update_ppv1_for_user_no_session,
-                ((user,) for user in user_list)
-            )
+    app.session.logger.info('[ppv1] -> Done.')
 
-def recalculate_ppv1_all_scores(min_status: int = -1, workers: int = 10) -> None:
+def recalculate_ppv1_all_scores(min_status: int = -1, workers: int = 10, range_size: int = 1000) -> None:
     """Recalculate ppv1 for all scores above a certain status"""
     if config.FROZEN_PPV1_UPDATES:
         app.session.logger.info('[ppv1] -> ppv1 updates are disabled, skipping...')
         return
 
     with app.session.database.managed_session() as session:
-        all_scores = session.query(DBScore) \
-            .filter(DBScore.status_pp >= min_status) \
-            .order_by(DBScore.ppv1.desc()) \
-            .all()
-
-        app.session.logger.info(f'[ppv1] -> Recalculating ppv1 for {len(all_scores)} scores...')
-
-        # Adjust pool size
-        config.POSTGRES_POOL_SIZE = 1
-        config.POSTGRES_POOL_SIZE_OVERFLOW = -1
-        os.environ['POSTGRES_POOL_SIZE'] = '1'
-        os.environ['POSTGRES_POOL_SIZE_OVERFLOW'] = '-1'
+        score_ranges = list(streaming.iterate_score_ranges(
+            session,
+            DBScore.status_pp >= min_status,
+            range_size=int(range_size)
+        ))
+
+    app.session.logger.info(f'[ppv1] -> Recalculating ppv1 for {len(score_ranges)} score ranges...')
+
+    with processes.create_pool(workers) as pool:
+        pool.starmap(
+            recalculate_ppv1_slice,
+            ((score_range, min_status) for score_range in score_ranges),
+            chunksize=1
+        )
 
-        with multiprocessing.Pool(int(workers)) as pool:
-            pool.map(
-                recalculate_ppv1_slice,
-                chunks(all_scores, len(all_scores) // int(workers))
-            )
+    app.session.logger.info('[ppv1] -> Done.')
 
-        app.session.logger.info('[ppv1] -> Done.')
-
-def recalculate_ppv1_slice(all_scores: List[DBScore]) -> None:
-    app.session.database.engine.dispose()
+def recalculate_ppv1_slice(score_range: Tuple[int, int], min_status: int = -1) -> None:
+    min_id, max_id = score_range
 
     with app.session.database.managed_session() as session:
-        for index, score in enumerate(all_scores):
-            ppv1 = performance.calculate_ppv1(score, session)
+        score_batches = streaming.iterate_scores(
+            session,
+            DBScore.status_pp >= min_status,
+            min_id=min_id,
+            max_id=max_id
+        )
 
-            session.query(DBScore) \
-                .filter(DBScore.id == score.id) \
-                .update({'ppv1': ppv1}, synchronize_session=False)
+        updater = BulkUpdater(session, DBScore.ppv1)
 
-            app.session.logger.info(
-                f'[ppv1] -> Updated ppv1 for: {score.id} ({ppv1})'
-            )
+        for score_chunk in score_batches:
+            for score in score_chunk:
+                ppv1 = performance.calculate_ppv1(score, session)
+                updater.add(score.id, ppv1)
 
-            if index % 1000 == 0:
-                session.commit()
+                app.session.logger.info(
+                    f'[ppv1] -> Updated ppv1 for: {score.id} ({ppv1})'
+                )
 
-def update_ppv1_for_user_no_session(user: DBUser) -> None:
-    # Reset the database connection pool
-    app.session.database.engine.dispose()
+            updater.flush()
+            session.commit()
 
+def update_ppv1_for_user_id(user_id: int) -> None:
     with app.session.database.managed_session() as session:
+        if not (user := users.fetch_by_id(user_id, session=session)):
+            app.session.logger.warning(f'[ppv1] -> User "{user_id}" was not found.')
+            return
+
         update_ppv1_for_user(user, session)
 
 def resolve_user_ppv1(user: DBUser) -> float:
@@ -157,7 +169,3 @@ def resolve_user_ppv1(user: DBUser) -> float:
 
     user.stats.sort(key=lambda s: s.mode)
     return user.stats[0].ppv1
-
-def chunks(list: list, amount: int):
-    for i in range(0, len(list), amount):
-        yield list[i:i + amount]
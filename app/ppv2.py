@@ -1,94 +1,117 @@
 
 from app.common.database.repositories import users, scores, stats
 from app.common.config import config_instance as config
-from app.common.database import DBScore, DBUser
+from app.common.database import DBBeatmap, DBScore, DBStats, DBUser
 from app.common.helpers import performance
 from app.common.cache import leaderboards
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm import Session
-from typing import List
-
-import multiprocessing
+from app.weighting import fetch_weighted_stats
+from app.writers import BulkUpdater
+from typing import Dict, List, Tuple
+from app import processes
+from concurrent.futures import ThreadPoolExecutor
+from app import streaming
+
+import hashlib
 import math
 import app
-import os
+
+FINGERPRINTS_KEY = 'bancho:ppv2:fingerprints'
 
 def recalculate_ppv2_for_user(user: DBUser, session: Session):
     user.stats.sort(key=lambda x: x.mode)
+    exclude_approved = not config.APPROVED_MAP_REWARDS
+
+    with BulkUpdater(session, DBScore.pp) as updater:
+        for user_stats in user.stats:
+            best_scores = scores.fetch_best(
+                user_id=user.id,
+                mode=user_stats.mode,
+                exclude_approved=exclude_approved,
+                session=session
+            )
 
-    for user_stats in user.stats:
-        best_scores = scores.fetch_best(
-            user_id=user.id,
-            mode=user_stats.mode,
-            exclude_approved=(not config.APPROVED_MAP_REWARDS),
-            session=session
-        )
+            app.session.logger.info(f'[ppv2] -> Updating {user.name} ({user_stats.mode}) ...')
 
-        app.session.logger.info(f'[ppv2] -> Updating {user.name} ({user_stats.mode}) ...')
+            for score in best_scores:
+                pp = performance.calculate_ppv2(score)
 
-        for score in best_scores:
-            pp = performance.calculate_ppv2(score)
+                if not pp:
+                    app.session.logger.warning(f'[ppv2] -> Failed to update pp for: {score.id}')
+                    continue
 
-            if not pp:
-                app.session.logger.warning(f'[ppv2] -> Failed to update pp for: {score.id}')
-                continue
+                # Avoid flagging the score as dirty, the
+                # updater takes care of writing the new value
+                set_committed_value(score, 'pp', pp)
+                updater.add(score.id, pp)
 
-            score.pp = pp
-            scores.update(score.id, {'pp': score.pp}, session=session)
+    # Weight the new pp values of all modes with a single query
+    weighted_stats = fetch_weighted_stats(session, [user.id], exclude_approved)
 
-        app.session.logger.info(f'[ppv2] -> Current pp: {user_stats.pp}')
-        best_scores.sort(key=lambda x: x.pp, reverse=True)
+    for user_stats in user.stats:
+        if not (weighted := weighted_stats.get((user.id, user_stats.mode))):
+            continue
+
+        app.session.logger.info(f'[ppv2] -> Current pp: {user_stats.pp} ({user_stats.mode})')
 
-        if best_scores:
-            # Update pp & acc
-            user_stats.pp = calculate_weighted_ppv2(best_scores)
-            user_stats.acc = calculate_weighted_acc(best_scores)
+        # Update pp & acc
+        user_stats.pp = weighted.pp
+        user_stats.acc = weighted.acc
 
+        with app.session.redis.buffered():
             leaderboards.update(
                 user_stats,
                 user.country.lower()
             )
 
-            user_stats.rank = leaderboards.global_rank(
-                user_stats.user_id,
-                user_stats.mode
-            )
+        user_stats.rank = leaderboards.global_rank(
+            user_stats.user_id,
+            user_stats.mode
+        )
 
-            stats.update(
-                user.id,
-                user_stats.mode,
-                {
-                    'pp': user_stats.pp,
-                    'acc': user_stats.acc,
-                    'rank': user_stats.rank,
-                },
-                session=session
-            )
+        stats.update(
+            user.id,
+            user_stats.mode,
+            {
+                'pp': user_stats.pp,
+                'acc': user_stats.acc,
+                'rank': user_stats.rank,
+            },
+            session=session
+        )
 
-        app.session.logger.info(f'[ppv2] -> Recalculated pp: {user_stats.pp}')
+        app.session.logger.info(f'[ppv2] -> Recalculated pp: {user_stats.pp} ({user_stats.mode})')
 
-def recalculate_failed_ppv2_calculations():
-    with app.session.database.managed_session() as session:
-        failed_scores = session.query(DBScore) \
-            .filter(DBScore.pp == 0) \
-            .all()
+def recalculate_failed_ppv2_calculations(batch_size: int = 1000):
+    with app.session.database.managed_session() as session, app.session.instance.cached():
+        updater = BulkUpdater(session, DBScore.pp, batch_size)
+        score_batches = streaming.iterate_scores(
+            session,
+            DBScore.pp == 0,
+            batch_size=batch_size
+        )
 
-        for score in failed_scores:
-            try:
-                pp = performance.calculate_ppv2(score)
-            except Exception as e:
-                app.session.logger.warning(f'[ppv2] -> Exception while recalculating pp for: {score.id} ({e})')
-                continue
+        for failed_scores in score_batches:
+            for score in failed_scores:
+                try:
+                    pp = performance.calculate_ppv2(score)
+                except Exception as e:
+                    app.session.logger.warning(f'[ppv2] -> Exception while recalculating pp for: {score.id} ({e})')
+                    continue
 
-            if not pp:
-                app.session.logger.warning(f'[ppv2] -> Failed to update pp for: {score.id}')
-                continue
+                if not pp:
+                    app.session.logger.warning(f'[ppv2] -> Failed to update pp for: {score.id}')
+                    continue
 
-            score.pp = round(pp, 8)
-            scores.update(score.id, {'pp': score.pp}, session=session)
-            app.session.logger.info(f'[ppv2] -> Updated pp for: {score.id} ({score.pp})')
+                updater.add(score.id, round(pp, 8))
+                app.session.logger.info(f'[ppv2] -> Updated pp for: {score.id} ({round(pp, 8)})')
+
+            updater.flush()
+            session.commit()
 
 def recalculate_ppv2():
-    with app.session.database.managed_session() as session:
+    with app.session.database.managed_session() as session, app.session.instance.cached():
         all_users = users.fetch_all(session=session)
 
         for user in all_users:
@@ -109,53 +132,64 @@ def recalculate_ppv2_multiprocessing(workers: int = 10) -> None:
     with app.session.database.managed_session() as session:
         app.session.logger.info(f'[ppv2] -> Updating ppv2 calculations ({workers} workers)...')
 
-        user_list = users.fetch_all(session=session)
-        user_list.sort(key=lambda user: (user.stats[0].pp if user.stats else math.inf), reverse=True)
+        # Heavy players are queued first, so that the
+        # remaining workers can pick up the smaller ones
+        user_rows = session.query(DBUser.id) \
+            .outerjoin(DBStats, (DBStats.user_id == DBUser.id) & (DBStats.mode == 0)) \
+            .filter(DBUser.restricted == False) \
+            .order_by(DBStats.pp.desc().nulls_last(), DBUser.id) \
+            .all()
+
+        user_ids = [user_id for (user_id,) in user_rows]
+
+    with processes.create_pool(workers) as pool:
+        completed_users = pool.imap_unordered(
+            recalculate_ppv2_for_user_id,
+            user_ids,
+            chunksize=1
+        )
 
-        # Split the list into chunks
-        chunk_size = math.ceil(len(user_list) / workers)
-        user_chunks = list(chunks(user_list, chunk_size))
+        for index, _ in enumerate(completed_users, start=1):
+            if index % 1000 != 0:
+                continue
 
-        # Create a pool of workers
-        with multiprocessing.Pool(workers) as pool:
-            pool.starmap(
-                recalculate_ppv2_for_chunk,
-                ((user_chunk,) for user_chunk in user_chunks)
+            app.session.logger.info(
+                f'[ppv2] -> Progress: {index}/{len(user_ids)} users.'
             )
 
-def recalculate_ppv2_for_chunk(users: List[DBUser]) -> None:
-    # Adjust pool size
-    config.POSTGRES_POOL_SIZE = 1
-    config.POSTGRES_POOL_SIZE_OVERFLOW = -1
-    os.environ['POSTGRES_POOL_SIZE'] = '1'
-    os.environ['POSTGRES_POOL_SIZE_OVERFLOW'] = '-1'
+    app.session.logger.info(f'[ppv2] -> Done.')
 
-    with app.session.database.managed_session() as session:
-        app.session.logger.info(f'[ppv2] -> Updating ppv2 calculations ({len(users)} users)...')
+def recalculate_ppv2_for_user_id(user_id: int) -> None:
+    with app.session.database.managed_session() as session, app.session.instance.cached():
+        if not (user := users.fetch_by_id(user_id, session=session)):
+            app.session.logger.warning(f'[ppv2] -> User "{user_id}" was not found.')
+            return
 
-        for user in users:
-            recalculate_ppv2_for_user(
-                user,
-                session
-            )
-            session.commit()
+        recalculate_ppv2_for_user(
+            user,
+            session
+        )
 
-        app.session.logger.info(f'[ppv2] -> Done.')
+def recalculate_ppv2_all_scores(batch_size: int = 500, group_by_beatmap: bool = False) -> None:
+    if group_by_beatmap:
+        return recalculate_ppv2_all_scores_by_beatmap(batch_size)
 
-def recalculate_ppv2_all_scores() -> None:
-    current_index = 0
-    scores_per_index = 500
+    with app.session.database.managed_session() as session, app.session.instance.cached():
+        # Fingerprint the files before calculating, so that files
+        # which change during the run are picked up next time
+        fingerprints = fetch_fingerprints(fetch_scored_beatmaps(session))
 
-    with app.session.database.managed_session() as session:
-        while True:
-            score_chunk = session.query(DBScore) \
-                .order_by(DBScore.status_pp.desc()) \
-                .offset(current_index * scores_per_index) \
-                .limit(scores_per_index) \
-                .all()
+        score_batches = streaming.iterate_scores(
+            session,
+            batch_size=batch_size
+        )
+
+        updater = BulkUpdater(session, DBScore.pp, batch_size)
 
-            if not score_chunk:
-                break
+        for index, score_chunk in enumerate(score_batches):
+            # Keep scores of the same beatmap next to each
+            # other, so that its file is only loaded once
+            score_chunk.sort(key=beatmap_sort_key)
 
             for score in score_chunk:
                 pp = performance.calculate_ppv2(score)
@@ -164,85 +198,204 @@ def recalculate_ppv2_all_scores() -> None:
                     app.session.logger.warning(f'[ppv2] -> Failed to update pp for: {score.id}')
                     continue
 
-                score.pp = pp
-                scores.update(score.id, {'pp': score.pp}, session=session)
+                updater.add(score.id, pp)
 
+            updater.flush()
             app.session.logger.info(
-                f'[ppv2] -> Recalculated chunk #{current_index} ({scores_per_index} scores).'
+                f'[ppv2] -> Recalculated chunk #{index} ({len(score_chunk)} scores).'
             )
-            current_index += 1
             session.commit()
 
+    store_fingerprints(fingerprints)
     app.session.logger.info(f'[ppv2] -> Done.')
 
-def recalculate_ppv2_all_scores_multiprocessing(workers: int = 10) -> None:
+def recalculate_ppv2_all_scores_by_beatmap(batch_size: int = 500) -> None:
     with app.session.database.managed_session() as session:
-        all_scores = session.query(DBScore) \
-            .order_by(DBScore.status_pp.desc()) \
-            .all()
+        beatmap_ids = fetch_scored_beatmaps(session)
 
         app.session.logger.info(
-            f'[ppv2] -> Recalculating ppv2 for {len(all_scores)} scores ({workers} workers)...'
+            f'[ppv2] -> Recalculating ppv2 for {len(beatmap_ids)} beatmaps...'
         )
 
-        if not all_scores:
-            app.session.logger.info('[ppv2] -> Done.')
-            return
+        recalculate_ppv2_for_beatmaps(
+            beatmap_ids,
+            session,
+            batch_size
+        )
+
+    app.session.logger.info(f'[ppv2] -> Done.')
+
+def recalculate_ppv2_incremental(batch_size: int = 500) -> None:
+    """Recalculate ppv2 for scores on beatmaps with a stale calculation fingerprint"""
+    with app.session.database.managed_session() as session:
+        beatmap_ids = fetch_scored_beatmaps(session)
+
+        stored_fingerprints = app.session.redis.hgetall(FINGERPRINTS_KEY)
+        fingerprints = fetch_fingerprints(beatmap_ids)
+
+        stale_beatmaps = [
+            beatmap_id
+            for beatmap_id, fingerprint in fingerprints.items()
+            if stored_fingerprints.get(str(beatmap_id).encode()) != fingerprint.encode()
+        ]
 
-        # Keep each worker on a single database connection.
-        config.POSTGRES_POOL_SIZE = 1
-        config.POSTGRES_POOL_SIZE_OVERFLOW = -1
-        os.environ['POSTGRES_POOL_SIZE'] = '1'
-        os.environ['POSTGRES_POOL_SIZE_OVERFLOW'] = '-1'
+        app.session.logger.info(
+            f'[ppv2] -> Found {len(stale_beatmaps)} beatmaps with stale calculations '
+            f'({app.session.instance.version}).'
+        )
+
+        recalculate_ppv2_for_beatmaps(
+            stale_beatmaps,
+            session,
+            batch_size
+        )
 
-        chunk_size = max(1, math.ceil(len(all_scores) / int(workers)))
-        session.expunge_all()
+    app.session.logger.info(f'[ppv2] -> Done.')
 
-        with multiprocessing.Pool(int(workers)) as pool:
-            pool.map(
-                recalculate_ppv2_score_slice,
-                chunks(all_scores, chunk_size)
+def recalculate_ppv2_for_beatmaps(
+    beatmap_ids: List[int],
+    session: Session,
+    batch_size: int = 500,
+    beatmaps_per_commit: int = 50
+) -> None:
+    updater = BulkUpdater(session, DBScore.pp, batch_size)
+    pending_fingerprints: Dict[int, str] = {}
+
+    for index, beatmap_id in enumerate(beatmap_ids, start=1):
+        # This beatmap will not be visited again in this run,
+        # so its file is only kept until all of its scores are done
+        with app.session.instance.cached():
+            # Fingerprint the exact file, that the calculator is going to use
+            fingerprint = calculation_fingerprint(app.session.instance.beatmap_file(beatmap_id))
+
+            score_batches = streaming.iterate_scores(
+                session,
+                DBScore.beatmap_id == beatmap_id,
+                batch_size=batch_size
             )
 
-    app.session.logger.info('[ppv2] -> Done.')
+            # Scores are sorted by mode & mods, but every score is still
+            # calculated on its own: only the file read is shared
+            for score_chunk in score_batches:
+                score_chunk.sort(key=beatmap_sort_key)
+
+                for score in score_chunk:
+                    pp = performance.calculate_ppv2(score)
+
+                    if not pp:
+                        app.session.logger.warning(f'[ppv2] -> Failed to update pp for: {score.id}')
+                        continue
+
+                    updater.add(score.id, pp)
+
+        pending_fingerprints[beatmap_id] = fingerprint
+
+        if len(pending_fingerprints) >= beatmaps_per_commit or index == len(beatmap_ids):
+            updater.flush()
+            session.commit()
 
-def recalculate_ppv2_score_slice(score_slice: List[DBScore]) -> None:
-    app.session.database.engine.dispose()
+            # Scores of these beatmaps are now up-to-date with
+            # the current calculator version and beatmap files
+            app.session.redis.hset(FINGERPRINTS_KEY, mapping=pending_fingerprints)
+            pending_fingerprints.clear()
 
+            app.session.logger.info(
+                f'[ppv2] -> Progress: {index}/{len(beatmap_ids)} beatmaps.'
+            )
+
+def recalculate_ppv2_all_scores_multiprocessing(workers: int = 10, range_size: int = 1000) -> None:
     with app.session.database.managed_session() as session:
-        for index, score in enumerate(score_slice, start=1):
-            pp = performance.calculate_ppv2(score)
+        # Only the id boundaries are kept in memory, the
+        # workers will stream their own ranges from the database
+        score_ranges = list(streaming.iterate_score_ranges(
+            session,
+            range_size=int(range_size)
+        ))
+
+        # Fingerprint the files before calculating, so that files
+        # which change during the run are picked up next time
+        fingerprints = fetch_fingerprints(fetch_scored_beatmaps(session))
+
+    app.session.logger.info(
+        f'[ppv2] -> Recalculating ppv2 for {len(score_ranges)} score ranges ({workers} workers)...'
+    )
+
+    if not score_ranges:
+        app.session.logger.info('[ppv2] -> Done.')
+        return
+
+    with processes.create_pool(workers) as pool:
+        pool.map(
+            recalculate_ppv2_score_slice,
+            score_ranges,
+            chunksize=1
+        )
 
-            if not pp:
-                app.session.logger.warning(f'[ppv2] -> Failed to update pp for: {score.id}')
-                continue
+    store_fingerprints(fingerprints)
+    app.session.logger.info('[ppv2] -> Done.')
 
-            session.query(DBScore) \
-                .filter(DBScore.id == score.id) \
-                .update({'pp': pp}, synchronize_session=False)
+def recalculate_ppv2_score_slice(score_range: Tuple[int, int]) -> None:
+    min_id, max_id = score_range
 
-            if index % 1000 == 0:
-                session.commit()
+    with app.session.database.managed_session() as session, app.session.instance.cached():
+        score_batches = streaming.iterate_scores(
+            session,
+            min_id=min_id,
+            max_id=max_id
+        )
 
-        session.commit()
+        updater = BulkUpdater(session, DBScore.pp)
 
-def calculate_weighted_ppv2(scores: List[DBScore]) -> float:
-    if not scores:
-        return 0
+        for score_chunk in score_batches:
+            score_chunk.sort(key=beatmap_sort_key)
 
-    weighted_pp = sum(score.pp * 0.95**index for index, score in enumerate(scores))
-    bonus_pp = 416.6667 * (1 - 0.9994 ** len(scores))
-    return weighted_pp + bonus_pp
+            for score in score_chunk:
+                pp = performance.calculate_ppv2(score)
 
-def calculate_weighted_acc(scores: List[DBScore]) -> float:
-    if not scores:
-        return 0
+                if not pp:
+                    app.session.logger.warning(f'[ppv2] -> Failed to update pp for: {score.id}')
+                    continue
+
+                updater.add(score.id, pp)
+
+            updater.flush()
+            session.commit()
+
+def fetch_scored_beatmaps(session: Session) -> List[int]:
+    """Fetch the id of every beatmap, that has at least one score"""
+    scored_beatmaps = session.query(DBScore.beatmap_id) \
+        .distinct() \
+        .subquery()
+
+    rows = session.query(DBBeatmap.id) \
+        .join(scored_beatmaps, scored_beatmaps.c.beatmap_id == DBBeatmap.id) \
+        .order_by(DBBeatmap.id) \
+        .all()
+
+    return [beatmap_id for (beatmap_id,) in rows]
+
+def fetch_fingerprints(beatmap_ids: List[int], threads: int = 8) -> Dict[int, str]:
+    """Fingerprint the current beatmap files of many beatmaps"""
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return dict(zip(beatmap_ids, executor.map(file_fingerprint, beatmap_ids)))
+
+def file_fingerprint(beatmap_id: int) -> str:
+    return calculation_fingerprint(app.session.beatmaps.osu(beatmap_id))
+
+def store_fingerprints(fingerprints: Dict[int, str], batch_size: int = 1000) -> None:
+    items = list(fingerprints.items())
+
+    for index in range(0, len(items), batch_size):
+        app.session.redis.hset(
+            FINGERPRINTS_KEY,
+            mapping=dict(items[index:index + batch_size])
+        )
 
-    weighted_acc = sum(score.acc * 0.95**index for index, score in enumerate(scores))
-    bonus_acc = 100.0 / (20 * (1 - 0.95 ** len(scores)))
-    return (weighted_acc * bonus_acc) / 100
+def calculation_fingerprint(beatmap_file: bytes | None) -> str:
+    # Missing files get a fingerprint too, so that they will
+    # only be retried once the file becomes available
+    checksum = hashlib.md5(beatmap_file).hexdigest() if beatmap_file else 'missing'
+    return f'{app.session.instance.version}:{checksum}'
 
-def chunks(list: list, amount: int):
-    amount = max(1, amount)
-    for i in range(0, len(list), amount):
-        yield list[i:i + amount]
+def beatmap_sort_key(score: DBScore) -> Tuple[int, int, int]:
+    return score.beatmap_id, score.mode, score.mods
@@ -0,0 +1,78 @@
+
+from app.common.config import config_instance as config
+from typing import Callable, Iterable, List, Tuple
+from multiprocessing.pool import Pool
+
+import multiprocessing
+import app.session
+import time
+import os
+
+def create_pool(workers: int) -> Pool:
+    """Create a process pool, where every worker owns a single database connection"""
+    # Worker processes will re-create the database
+    # engine on import, using these pool settings
+    config.POSTGRES_POOL_SIZE = 1
+    config.POSTGRES_POOL_SIZE_OVERFLOW = -1
+    os.environ['POSTGRES_POOL_SIZE'] = '1'
+    os.environ['POSTGRES_POOL_SIZE_OVERFLOW'] = '-1'
+
+    return multiprocessing.Pool(
+        max(1, int(workers)),
+        initializer=initialize_worker
+    )
+
+def initialize_worker() -> None:
+    # Drop any connections inherited from the parent process
+    app.session.database.engine.dispose()
+
+def load_checkpoint(checkpoint_key: str, resume: bool = True) -> int:
+    """Get the first id to process, based on the checkpoint of an interrupted run"""
+    checkpoint = app.session.redis.get(checkpoint_key)
+    return int(checkpoint) + 1 if checkpoint and resume else 0
+
+def process_ranges(
+    worker: Callable[[Tuple[int, int]], int],
+    id_ranges: List[Tuple[int, int]],
+    workers: int = 1,
+    checkpoint_key: str | None = None,
+    name: str = 'jobs'
+) -> int:
+    """Run a worker over (first_id, last_id) ranges, optionally on a process pool, and return the sum of its results"""
+    if int(workers) <= 1:
+        return track_ranges(id_ranges, map(worker, id_ranges), checkpoint_key, name)
+
+    with create_pool(workers) as pool:
+        # Results are returned in order, which
+        # allows us to move the checkpoint forward
+        results = pool.imap(worker, id_ranges)
+        return track_ranges(id_ranges, results, checkpoint_key, name)
+
+def track_ranges(
+    id_ranges: List[Tuple[int, int]],
+    results: Iterable[int],
+    checkpoint_key: str | None,
+    name: str
+) -> int:
+    started_at = time.time()
+    total = 0
+
+    for index, ((_, max_id), count) in enumerate(zip(id_ranges, results), start=1):
+        total += count
+
+        if checkpoint_key:
+            app.session.redis.set(checkpoint_key, max_id)
+
+        elapsed = max(time.time() - started_at, 0.001)
+        remaining = (len(id_ranges) - index) * (elapsed / index)
+
+        app.session.logger.info(
+            f'[{name}] -> Updated {count} rows up to id {max_id} '
+            f'({index}/{len(id_ranges)}, {total / elapsed:.0f} rows/s, ~{remaining:.0f}s remaining)'
+        )
+
+    if checkpoint_key:
+        # Start from the beginning on the next run
+        app.session.redis.delete(checkpoint_key)
+
+    return total
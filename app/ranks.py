@@ -1,7 +1,16 @@
 
-from app.common.database import users, stats, histories
+from app.common.database.objects import DBRankHistory, DBStats, DBUser
 from app.common.config import config_instance as config
+from app.common.database import users, histories
 from app.common.cache import leaderboards
+from sqlalchemy.orm.attributes import set_committed_value
+from app.writers import BulkRowUpdater
+from sqlalchemy.orm import Session
+from typing import Dict, List, Tuple
+from itertools import batched
+from datetime import datetime
+from app import watermarks
+from sqlalchemy import func
 
 import app.session
 
@@ -10,54 +19,125 @@ def update_ranks() -> None:
     app.session.logger.info('[ranks] -> Updating rank history...')
 
     with app.session.database.managed_session() as session:
-        for user in users.fetch_all(session=session):
-            for user_stats in user.stats:
-                if user_stats.playcount <= 0:
-                    continue
-
-                global_rank = leaderboards.global_rank(
-                    user.id,
-                    user_stats.mode
-                )
-
-                peak_rank = histories.fetch_peak_global_rank(
-                    user.id,
-                    user_stats.mode,
-                    session=session
-                )
-
-                if user_stats.rank != global_rank:
-                    # Database rank desynced from redis
-                    stats.update(
-                        user.id,
-                        user_stats.mode,
-                        {'rank': global_rank},
-                        session=session
-                    )
-                    user_stats.rank = global_rank
-
-                    if not config.FROZEN_RANK_UPDATES:
-                        # Update rank history
-                        histories.update_rank(
-                            user_stats,
-                            user.country,
-                            session=session
-                        )
-
-                if user_stats.peak_rank != peak_rank:
-                    # User achieved a higher rank
-                    stats.update(
-                        user.id, user_stats.mode,
-                        {'peak_rank': peak_rank},
+        stats_rows = session.query(DBStats, DBUser.country) \
+            .join(DBUser, DBUser.id == DBStats.user_id) \
+            .filter(DBUser.restricted == False) \
+            .filter(DBStats.playcount > 0) \
+            .all()
+
+        global_ranks = fetch_global_ranks([user_stats for user_stats, _ in stats_rows])
+
+        rank_updater = BulkRowUpdater(
+            session,
+            (DBStats.user_id, DBStats.mode),
+            (DBStats.rank,)
+        )
+        peak_rank_updater = BulkRowUpdater(
+            session,
+            (DBStats.user_id, DBStats.mode),
+            (DBStats.peak_rank,)
+        )
+
+        for user_stats, country in stats_rows:
+            global_rank = global_ranks[(user_stats.user_id, user_stats.mode)]
+
+            if user_stats.rank != global_rank:
+                # Database rank desynced from redis
+                rank_updater.add(user_stats.user_id, user_stats.mode, global_rank)
+                set_committed_value(user_stats, 'rank', global_rank)
+
+                if not config.FROZEN_RANK_UPDATES:
+                    # Update rank history
+                    histories.update_rank(
+                        user_stats,
+                        country,
                         session=session
                     )
 
-            session.commit()
-            app.session.logger.info(f'[ranks] -> Updated {user.name}.')
+        # Peak ranks include the rank history entries from above
+        session.flush()
+        peak_ranks = fetch_peak_ranks(session)
 
-        app.session.logger.info('[ranks] -> Done.')
+        for user_stats, _ in stats_rows:
+            peak_rank = peak_ranks.get((user_stats.user_id, user_stats.mode), 0)
+
+            if not peak_rank:
+                # User has no rank history yet
+                continue
+
+            if user_stats.peak_rank != peak_rank:
+                # User achieved a higher rank
+                peak_rank_updater.add(user_stats.user_id, user_stats.mode, peak_rank)
+
+        rank_updater.flush()
+        peak_rank_updater.flush()
+
+        app.session.logger.info(
+            f'[ranks] -> Updated {rank_updater.total} ranks '
+            f'and {peak_rank_updater.total} peak ranks.'
+        )
 
-def index_ranks(force: bool = False) -> None:
+def fetch_global_ranks(stats_list: List[DBStats], batch_size: int = 5000) -> Dict[Tuple[int, int], int]:
+    """Fetch the global ranks of many players, with pipelined redis lookups"""
+    global_ranks = {}
+
+    for mode in sorted({user_stats.mode for user_stats in stats_list}):
+        mode_stats = [user_stats for user_stats in stats_list if user_stats.mode == mode]
+
+        if not (leaderboard_key := global_rank_key(mode_stats[0])):
+            # Unable to resolve the leaderboard key
+            global_ranks.update({
+                (user_stats.user_id, user_stats.mode): fetch_global_rank(user_stats)
+                for user_stats in mode_stats
+            })
+            continue
+
+        for batch in batched(mode_stats, batch_size):
+            with app.session.redis.pipeline(transaction=False) as pipeline:
+                for user_stats in batch:
+                    pipeline.zrevrank(leaderboard_key, user_stats.user_id)
+
+                ranks = pipeline.execute()
+
+            for user_stats, rank in zip(batch, ranks):
+                global_ranks[(user_stats.user_id, user_stats.mode)] = (
+                    rank + 1 if rank is not None else 0
+                )
+
+    return global_ranks
+
+def global_rank_key(user_stats: DBStats) -> str | None:
+    """Resolve the key, that leaderboards.global_rank reads from"""
+    # The leaderboards module owns the key format, so
+    # it is taken from the command of a single lookup
+    with app.session.redis.recording() as commands:
+        fetch_global_rank(user_stats)
+
+    return next(
+        (args[1] for args in commands if str(args[0]).upper() == 'ZREVRANK'),
+        None
+    )
+
+def fetch_global_rank(user_stats: DBStats) -> int:
+    return leaderboards.global_rank(user_stats.user_id, user_stats.mode)
+
+def fetch_peak_ranks(session: Session) -> Dict[Tuple[int, int], int]:
+    """Fetch the peak global ranks of all players in all modes, with a single query"""
+    rows = session.query(
+        DBRankHistory.user_id,
+        DBRankHistory.mode,
+        func.min(DBRankHistory.global_rank)
+    ) \
+        .filter(DBRankHistory.global_rank > 0) \
+        .group_by(DBRankHistory.user_id, DBRankHistory.mode) \
+        .all()
+
+    return {
+        (user_id, mode): peak_rank
+        for user_id, mode, peak_rank in rows
+    }
+
+def index_ranks(force: bool = False, flush_every: int = 500, catch_up_passes: int = 3) -> None:
     """Check if the redis leaderboards are empty and rebuild them if necessary"""
     if leaderboards.top_players(0) and not force:
         app.session.logger.info(f'[ranks] -> Leaderboard is not empty, please clear it first.')
@@ -66,24 +146,64 @@ def index_ranks(force: bool = False) -> None:
     app.session.logger.info(f'[ranks] -> Indexing player ranks...')
 
     with app.session.database.managed_session() as session:
+        started_at = datetime.now()
         active_players = users.fetch_all(session=session)
 
-        for player in active_players:
-            for stats in player.stats:
-                leaderboards.update(
-                    stats,
-                    player.country.lower()
+        # Rebuild into temporary keys, that will replace
+        # the live leaderboards once everything is indexed
+        with app.session.redis.shadowed(replace_families=True), \
+             app.session.redis.buffered(flush_every) as writer:
+            for player in active_players:
+                index_player(player, session)
+                writer.checkpoint()
+
+            # Live updates of players that were active during the rebuild
+            # would be lost on the swap, so these players are indexed again
+            for _ in range(catch_up_passes):
+                pass_started_at = datetime.now()
+
+                # Reload their stats, instead of using the snapshot
+                session.expire_all()
+                recent_players = fetch_players_active_since(
+                    session,
+                    started_at - watermarks.safety_margin
                 )
-                leaderboards.update_leader_scores(
-                    stats,
-                    player.country.lower(),
-                    session=session
+
+                if not recent_players:
+                    break
+
+                app.session.logger.info(
+                    f'[ranks] -> Re-indexing {len(recent_players)} players, that were active during the rebuild...'
                 )
 
-            leaderboards.update_kudosu(
-                player.id,
-                player.country.lower(),
-                session=session
-            )
+                for player in recent_players:
+                    index_player(player, session)
+                    writer.checkpoint()
+
+                started_at = pass_started_at
 
         app.session.logger.info('[ranks] -> Done.')
+
+def index_player(player: DBUser, session: Session) -> None:
+    for stats in player.stats:
+        leaderboards.update(
+            stats,
+            player.country.lower()
+        )
+        leaderboards.update_leader_scores(
+            stats,
+            player.country.lower(),
+            session=session
+        )
+
+    leaderboards.update_kudosu(
+        player.id,
+        player.country.lower(),
+        session=session
+    )
+
+def fetch_players_active_since(session: Session, since: datetime) -> List[DBUser]:
+    return session.query(DBUser) \
+        .filter(DBUser.restricted == False) \
+        .filter(DBUser.latest_activity >= since) \
+        .all()
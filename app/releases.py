@@ -3,11 +3,13 @@ from app.common.config import config_instance as config
 from app.common.database.objects import DBReleaseFiles
 from app.common.database.repositories import releases
 from app.common.webhooks import Webhook, Embed
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from sqlalchemy.orm import Session
 from datetime import datetime
 from typing import Iterator
 
 import requests
+import hashlib
 import app
 
 session = requests.Session()
@@ -17,35 +19,79 @@ session.headers.update({
 })
 windows_os_parameter = "10.0.0.26100.1.0"
 
+# Maximum amount of concurrent requests to osu! servers
+max_concurrency = 4
+
 def release_updates(*release_streams) -> None:
-    with app.session.database.managed_session() as session:
-        if not config.RELEASE_UPDATES_ENABLED:
-            app.session.logger.info("[releases] -> Release updates are disabled. Skipping...")
-            return
+    if not config.RELEASE_UPDATES_ENABLED:
+        app.session.logger.info("[releases] -> Release updates are disabled. Skipping...")
+        return
 
-        for stream in release_streams:
-            app.session.logger.info(f'[releases] -> Checking for updates on stream "{stream}"...')
-            updates = check_stream(stream, session)
+    with ThreadPoolExecutor(max_concurrency) as executor:
+        app.session.logger.info(f'[releases] -> Checking for updates on streams {", ".join(release_streams)}...')
+
+        # Fetch every stream & os variant at once
+        stream_requests = [
+            (stream, os)
+            for stream in release_streams
+            for os in (windows_os_parameter, None)
+        ]
+        responses = executor.map(lambda request: fetch_stream(*request), stream_requests)
+        stream_data: dict[str, list[dict]] = {stream: [] for stream in release_streams}
+        cache_entries: dict[str, dict[str, str]] = {}
+
+        for (stream, os), (data, cache_entry) in zip(stream_requests, responses):
+            stream_data[stream].extend(data)
+
+            if cache_entry:
+                cache_entries[stream_cache_key(stream, os)] = cache_entry
+
+        with app.session.database.managed_session() as session:
+            created_files = [
+                (created_file, stream)
+                for stream, data in stream_data.items()
+                for created_file in check_stream(stream, data, session)
+            ]
+            session.commit()
+
+            # Responses are only marked as seen, once
+            # their files were successfully stored
+            for key, cache_entry in cache_entries.items():
+                app.session.redis.hset(key, mapping=cache_entry)
+
+            for created_file, stream in created_files:
+                # Detach the file from the session, so that it
+                # can safely be passed to the worker threads
+                session.refresh(created_file)
+                session.expunge(created_file)
 
-            for created_file in updates:
                 app.session.logger.info(
                     f'[releases] -> New release file created: '
                     f'{created_file.filename} / {created_file.file_version} ({created_file.file_hash})'
                 )
-                post_update_actions(created_file, stream)
 
-        app.session.logger.info('[releases] -> Done.')
+        futures = [
+            future
+            for created_file, stream in created_files
+            for future in post_update_actions(executor, created_file, stream)
+        ]
+
+        for future in as_completed(futures):
+            if exception := future.exception():
+                app.session.logger.error(f'[releases] -> Failed to run post-update actions: {exception}')
 
-def check_stream(stream: str, database_session: Session) -> Iterator[DBReleaseFiles]:
-    data_windows = fetch_stream(stream, windows_os_parameter)
-    data_linux = fetch_stream(stream)
-    data = data_windows + data_linux
+    app.session.logger.info('[releases] -> Done.')
+
+def check_stream(stream: str, data: list[dict], database_session: Session) -> Iterator[DBReleaseFiles]:
+    existing_versions = fetch_existing_versions(
+        {int(file["file_version"]) for file in data},
+        database_session
+    )
 
     for file in data:
         file_version = int(file["file_version"])
-        existing_file = releases.fetch_official_file_by_version(file_version, database_session)
 
-        if existing_file:
+        if file_version in existing_versions:
             app.session.logger.debug(f'[releases] -> File with version "{file_version}" already exists. Skipping...')
             continue
 
@@ -60,10 +106,30 @@ def check_stream(stream: str, database_session: Session) -> Iterator[DBReleaseFi
             timestamp=datetime.strptime(file["timestamp"], '%Y-%m-%d %H:%M:%S'),
             session=database_session
         )
-        database_session.commit()
+        existing_versions.add(file_version)
         yield release
 
-def fetch_stream(stream: str, os: str | None = None) -> list[dict]:
+def fetch_existing_versions(file_versions: set[int], database_session: Session) -> set[int]:
+    if not file_versions:
+        return set()
+
+    rows = database_session.query(DBReleaseFiles.file_version) \
+        .filter(DBReleaseFiles.file_version.in_(file_versions)) \
+        .all()
+
+    return {file_version for (file_version,) in rows}
+
+def fetch_stream(stream: str, os: str | None = None) -> tuple[list[dict], dict[str, str]]:
+    """Fetch new files of a release stream, along with the cache entry for this response"""
+    cached_response = app.session.redis.hgetall(stream_cache_key(stream, os))
+    headers = {}
+
+    if etag := cached_response.get(b'etag'):
+        headers["If-None-Match"] = etag.decode()
+
+    if last_modified := cached_response.get(b'last_modified'):
+        headers["If-Modified-Since"] = last_modified.decode()
+
     params = {
         "action": "check",
         "stream": stream
@@ -76,25 +142,49 @@ def fetch_stream(stream: str, os: str | None = None) -> list[dict]:
 
     response = session.get(
         "https://osu.ppy.sh/web/check-updates.php",
-        params=params
+        params=params,
+        headers=headers
     )
 
+    if response.status_code == 304:
+        app.session.logger.debug(f'[releases] -> Stream "{stream}" was not modified. Skipping...')
+        return [], {}
+
     if not response.ok:
         app.session.logger.error(f'[releases] -> Failed to check "{stream}" for updates: {response.text} ({response.status_code})')
-        return []
+        return [], {}
+
+    content_hash = hashlib.sha1(response.content).hexdigest()
+
+    if cached_response.get(b'hash') == content_hash.encode():
+        app.session.logger.debug(f'[releases] -> Stream "{stream}" did not change. Skipping...')
+        return [], {}
 
     data = response.json()
 
     if type(data) is not list:
         app.session.logger.error(f'[releases] -> Failed to check "{stream}" for updates: {data}')
-        return []
+        return [], {}
+
+    cache_entry = {
+        "hash": content_hash,
+        "etag": response.headers.get("ETag", ""),
+        "last_modified": response.headers.get("Last-Modified", "")
+    }
+
+    return data, cache_entry
 
-    return data
+def stream_cache_key(stream: str, os: str | None) -> str:
+    return f'bancho:releases:{stream}:{os or "default"}'
 
-def post_update_actions(file: DBReleaseFiles, stream: str) -> None:
-    notify_webhook(file, stream)
-    upload_to_s3(file.url_full)
-    upload_to_s3(file.url_patch)
+def post_update_actions(executor: ThreadPoolExecutor, file: DBReleaseFiles, stream: str) -> list[Future]:
+    # Every action is a separate task on the shared executor,
+    # which keeps the amount of concurrent downloads bounded
+    return [
+        executor.submit(notify_webhook, file, stream),
+        executor.submit(upload_to_s3, file.url_full),
+        executor.submit(upload_to_s3, file.url_patch)
+    ]
 
 def upload_to_s3(url: str) -> None:
     if not url:
@@ -1,12 +1,21 @@
 
 from app.common.helpers.score import calculate_rx_score
-from app.common.database.objects import DBScore
-from app.common.database import users, scores
-from collections import defaultdict
-from sqlalchemy import or_
+from app.common.database.objects import DBScore, DBUser
+from app.common.database import users
+from sqlalchemy.orm import InstrumentedAttribute, Session, selectinload
+from sqlalchemy import case, func, update
+from app.writers import BulkUpdater
+from typing import Tuple
+from app import processes, streaming
+from functools import partial
 
 import app
 
+# Relax & Autopilot
+RELAXING_MODS = 128 | 8192
+
+STATUS_CHECKPOINT_KEY = 'bancho:jobs:score_statuses:checkpoint'
+
 def recalculate_pp_status(user_id: int, mode: int) -> None:
     """Recalculate the pp status of a user's scores"""
     app.session.logger.info(f'[users] -> Recalculating pp statuses of user...')
@@ -18,71 +27,18 @@ def recalculate_pp_status(user_id: int, mode: int) -> None:
             app.session.logger.warning(f'[users] -> User "{user_id}" was not found.')
             return
 
-        user_scores = session.query(DBScore) \
-            .filter(DBScore.user_id == user.id) \
-            .filter(DBScore.mode == mode) \
-            .filter(DBScore.status_pp > 1) \
-            .filter(DBScore.hidden == False) \
-            .all()
-
-        if not user_scores:
-            app.session.logger.warning(f'[users] -> User "{user_id}" has no scores ({mode}).')
-            return
-
-        # Sort scores by beatmap id
-        scores_dict = defaultdict(list)
-
-        for score in user_scores:
-            if score.relaxing:
-                # Exclude rx/ap from global pp rankings
-                scores.update(score.id, {'status_pp': 2}, session=session)
-                continue
-
-            scores_dict[score.beatmap_id].append(score)
-
-        for beatmap_id, beatmap_scores in scores_dict.items():
-            # Sort scores by pp
-            beatmap_scores.sort(key=lambda x: x.pp, reverse=True)
-
-            # Update best score
-            best_score = beatmap_scores[0]
-            scores.update(best_score.id, {'status_pp': 3}, session=session)
-
-            app.session.logger.info(f'[users] ({beatmap_id}) -> Best score: {best_score.pp}pp')
-
-            # Sort scores by mods
-            mods_dict = defaultdict(list)
-
-            for score in beatmap_scores:
-                mods_dict[score.mods].append(score)
-
-            for mods, scores_list in mods_dict.items():
-                # Sort scores by pp
-                scores_list.sort(key=lambda x: x.pp, reverse=True)
-
-                # Get best score with mods
-                mods_best_score = scores_list.pop(0)
-
-                # Update other scores to submitted status
-                for score in scores_list:
-                    best_score_ids = (mods_best_score.id, best_score.id)
-
-                    if score.id in best_score_ids:
-                        continue
-
-                    scores.update(score.id, {'status_pp': 2}, session=session)
-
-                if mods == best_score.mods:
-                    # Don't update the best score
-                    continue
+        updated_scores = update_pp_statuses(
+            session,
+            DBScore.user_id == user.id,
+            DBScore.mode == mode
+        )
 
-                # Update best mod-score
-                scores.update(mods_best_score.id, {'status_pp': 4}, session=session)
+        app.session.logger.info(f'[users] -> Updated {updated_scores} pp statuses.')
 
     app.session.logger.info(f'[users] -> Done.')
 
 def recalculate_score_status(user_id: int, mode: int) -> None:
-    """Recalculate the scpre status of a user's scores"""
+    """Recalculate the score status of a user's scores"""
     with app.session.database.managed_session() as session:
         user = users.fetch_by_id(user_id, session=session)
 
@@ -90,108 +46,212 @@ def recalculate_score_status(user_id: int, mode: int) -> None:
             app.session.logger.warning(f'[users] -> User "{user_id}" was not found.')
             return
 
-        # Recalculate score statuses
-        user_scores = session.query(DBScore) \
-            .filter(DBScore.user_id == user.id) \
-            .filter(DBScore.mode == mode) \
-            .filter(DBScore.status_score > 1) \
-            .filter(DBScore.hidden == False) \
-            .all()
-
-        if not user_scores:
-            app.session.logger.warning(f'[users] -> User "{user_id}" has no scores.')
-            return
-
-        # Sort scores by beatmap id
-        scores_dict = defaultdict(list)
-
-        for score in user_scores:
-            scores_dict[score.beatmap_id].append(score)
-
-        for beatmap_id, beatmap_scores in scores_dict.items():
-            # Sort scores by total score
-            beatmap_scores.sort(key=lambda x: x.total_score, reverse=True)
-
-            # Update best score
-            best_score = beatmap_scores[0]
-            scores.update(best_score.id, {'status_score': 3}, session=session)
-
-            app.session.logger.info(f'[users] <{user_id}> ({beatmap_id}) -> Best score: {best_score.total_score}')
-
-            # Sort scores by mods
-            mods_dict = defaultdict(list)
-
-            for score in beatmap_scores:
-                mods_dict[score.mods].append(score)
-
-            for mods, scores_list in mods_dict.items():
-                # Sort scores by total score
-                scores_list.sort(key=lambda x: x.total_score, reverse=True)
+        updated_scores = update_score_statuses(
+            session,
+            DBScore.user_id == user.id,
+            DBScore.mode == mode
+        )
 
-                # Get best score with mods
-                mods_best_score = scores_list.pop(0)
+        app.session.logger.info(f'[users] <{user_id}> -> Updated {updated_scores} score statuses.')
 
-                # Update other scores to submitted status
-                for score in scores_list:
-                    best_score_ids = (mods_best_score.id, best_score.id)
+    app.session.logger.info(f'[users] -> Done.')
 
-                    if score.id in best_score_ids:
-                        continue
+def recalculate_beatmap_statuses(beatmap_id: int, exclude_pp: bool = False) -> None:
+    """Recalculate the pp and score statuses of all scores on a beatmap"""
+    app.session.logger.info(f'[users] -> Recalculating statuses of beatmap "{beatmap_id}"...')
 
-                    scores.update(score.id, {'status_score': 2}, session=session)
+    with app.session.database.managed_session() as session:
+        updated_scores = update_score_statuses(session, DBScore.beatmap_id == beatmap_id)
 
-                if mods == best_score.mods:
-                    # Don't update the best score
-                    continue
+        if not exclude_pp:
+            updated_scores += update_pp_statuses(session, DBScore.beatmap_id == beatmap_id)
 
-                # Update best mod-score
-                scores.update(mods_best_score.id, {'status_score': 4}, session=session)
+        app.session.logger.info(f'[users] -> Updated {updated_scores} statuses.')
 
-    app.session.logger.info(f'[users] -> Done.')
+    app.session.logger.info('[users] -> Done.')
 
-def recalculate_score_statuses_all(exclude_pp: bool = False) -> None:
+def recalculate_score_statuses_all(
+    exclude_pp: bool = False,
+    batch_size: int = 1000,
+    workers: int = 1,
+    resume: bool = True
+) -> None:
     """Recalculate the pp and score statuses of all users"""
-    app.session.logger.info('[users] -> Recalculating statuses of all users...')
+    start_id = processes.load_checkpoint(STATUS_CHECKPOINT_KEY, resume)
 
     with app.session.database.managed_session() as session:
-        users_list = users.fetch_all(session=session)
-        users_list.sort(key=lambda x: x.id)
+        user_ranges = list(streaming.iterate_id_ranges(
+            session,
+            DBUser.id,
+            range_size=int(batch_size),
+            min_id=start_id
+        ))
+
+    app.session.logger.info(
+        f'[users] -> Recalculating statuses of all users '
+        f'({len(user_ranges)} ranges, starting at {start_id}, {workers} workers)'
+    )
+
+    recalculate_range = partial(
+        recalculate_score_statuses_range,
+        exclude_pp=exclude_pp
+    )
+
+    updated_scores = processes.process_ranges(
+        recalculate_range,
+        user_ranges,
+        workers,
+        checkpoint_key=STATUS_CHECKPOINT_KEY,
+        name='users'
+    )
+
+    app.session.logger.info(f'[users] -> Done. ({updated_scores} statuses updated)')
+
+def recalculate_score_statuses_range(user_range: Tuple[int, int], exclude_pp: bool = False) -> int:
+    with app.session.database.managed_session() as session:
+        user_criteria = DBScore.user_id.between(*user_range)
+        updated_scores = update_score_statuses(session, user_criteria)
+
+        if not exclude_pp:
+            updated_scores += update_pp_statuses(session, user_criteria)
+
+        session.commit()
+
+    return updated_scores
+
+def update_pp_statuses(session: Session, *criteria) -> int:
+    """Update the pp status of all matching scores, excluding rx/ap from the pp rankings"""
+    return update_statuses(
+        session,
+        DBScore.status_pp,
+        DBScore.pp,
+        *criteria,
+        exclude_relaxing=True
+    )
+
+def update_score_statuses(session: Session, *criteria) -> int:
+    """Update the score status of all matching scores"""
+    return update_statuses(
+        session,
+        DBScore.status_score,
+        DBScore.total_score,
+        *criteria
+    )
+
+def update_statuses(
+    session: Session,
+    status_column: InstrumentedAttribute,
+    order_column: InstrumentedAttribute,
+    *criteria,
+    exclude_relaxing: bool = False
+) -> int:
+    """Recalculate best (3), best-mod (4) & submitted (2) statuses with a single UPDATE"""
+    statuses = rank_statuses(
+        session,
+        status_column,
+        order_column,
+        *criteria,
+        exclude_relaxing=exclude_relaxing
+    )
+
+    statement = update(DBScore) \
+        .where(DBScore.id == statuses.c.id) \
+        .where(status_column != statuses.c.status) \
+        .values({status_column: statuses.c.status}) \
+        .execution_options(synchronize_session=False)
+
+    return session.execute(statement).rowcount
+
+def rank_statuses(
+    session: Session,
+    status_column: InstrumentedAttribute,
+    order_column: InstrumentedAttribute,
+    *criteria,
+    exclude_relaxing: bool = False
+):
+    """Build a subquery of (id, status) pairs for all matching scores"""
+    relaxing = DBScore.mods.op('&')(RELAXING_MODS) != 0
+    partition = [DBScore.user_id, DBScore.mode, DBScore.beatmap_id]
+
+    if exclude_relaxing:
+        # rx/ap scores should never compete with regular scores
+        partition.append(relaxing)
+
+    # Ties are resolved in favor of the older score
+    ordering = (order_column.desc().nulls_last(), DBScore.id)
+
+    beatmap_index = func.row_number().over(
+        partition_by=partition,
+        order_by=ordering
+    )
+
+    mods_index = func.row_number().over(
+        partition_by=(*partition, DBScore.mods),
+        order_by=ordering
+    )
+
+    conditions = [
+        (beatmap_index == 1, 3),
+        (mods_index == 1, 4)
+    ]
+
+    if exclude_relaxing:
+        conditions.insert(0, (relaxing, 2))
+
+    return session.query(
+        DBScore.id,
+        case(*conditions, else_=2).label('status')
+    ) \
+        .filter(status_column > 1) \
+        .filter(DBScore.hidden == False) \
+        .filter(*criteria) \
+        .subquery('statuses')
+
+def recalculate_rx_scores(workers: int = 1, range_size: int = 1000) -> None:
+    """Recalculate the total score of all rx/ap scores"""
+    with app.session.database.managed_session() as session:
+        score_ranges = list(streaming.iterate_score_ranges(
+            session,
+            DBScore.mods.op('&')(RELAXING_MODS) != 0,
+            range_size=int(range_size)
+        ))
 
-        for user in users_list:
-            recalculate_score_status(user.id, 0)
-            recalculate_score_status(user.id, 1)
-            recalculate_score_status(user.id, 2)
-            recalculate_score_status(user.id, 3)
+    app.session.logger.info(
+        f'[users] -> Recalculating rx/ap scores '
+        f'({len(score_ranges)} ranges, {workers} workers)...'
+    )
 
-            if exclude_pp:
-                continue
+    updated_scores = processes.process_ranges(
+        recalculate_rx_score_range,
+        score_ranges,
+        workers,
+        name='users'
+    )
 
-            recalculate_pp_status(user.id, 0)
-            recalculate_pp_status(user.id, 1)
-            recalculate_pp_status(user.id, 2)
-            recalculate_pp_status(user.id, 3)
+    app.session.logger.info(f'[users] -> Done. ({updated_scores} scores updated)')
 
-    app.session.logger.info('[users] -> Done.')
+def recalculate_rx_score_range(score_range: Tuple[int, int]) -> int:
+    min_id, max_id = score_range
 
-def recalculate_rx_scores() -> None:
     with app.session.database.managed_session() as session:
-        user_scores = session.query(DBScore) \
-            .filter(or_(
-                DBScore.mods.op('&')(128) != 0,
-                DBScore.mods.op('&')(8192) != 0
-            )) \
-            .order_by(DBScore.status_pp.desc()) \
+        updater = BulkUpdater(session, DBScore.total_score)
+
+        # Beatmaps are loaded with a single IN query per range,
+        # and shared between all scores that were set on them
+        range_scores = session.query(DBScore) \
+            .options(selectinload(DBScore.beatmap)) \
+            .filter(DBScore.id >= min_id) \
+            .filter(DBScore.id <= max_id) \
+            .filter(DBScore.mods.op('&')(RELAXING_MODS) != 0) \
             .all()
 
-        app.session.logger.info(
-            f'[users] -> Recalculating {len(user_scores)} rx/ap scores...'
-        )
+        for score in range_scores:
+            total_score = calculate_rx_score(score, score.beatmap)
 
-        for score in user_scores:
-            scores.update(
-                score.id,
-                {'total_score': calculate_rx_score(score, score.beatmap)},
-                session=session
-            )
+            if total_score != score.total_score:
+                updater.add(score.id, total_score)
 
-    app.session.logger.info('[users] -> Done.')
+        updater.flush()
+        session.commit()
+
+    return updater.total
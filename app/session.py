@@ -1,13 +1,14 @@
 
-from .common.helpers.performance import ppv2, ppv2_rosu
+from .calculator import CachedPerformanceCalculator
+from .common.helpers.performance import ppv2
 from .common.helpers.beatmaps import BeatmapResources
 from .common.cache.events import EventQueue
 from .common.database import Postgres
 from .common.storage import Storage
 from .common.config import Config
+from .pipelines import BufferedRedis
 
 from requests import Session
-from redis import Redis
 
 import logging
 
@@ -15,7 +16,7 @@ config = Config()
 database = Postgres(config)
 storage = Storage(config)
 
-redis = Redis(
+redis = BufferedRedis(
     config.REDIS_HOST,
     config.REDIS_PORT
 )
@@ -32,5 +33,5 @@ requests.headers = {
 }
 
 # Initialize ppv2 calculator
-instance = ppv2_rosu.RosuPerformanceCalculator(beatmaps)
+instance = CachedPerformanceCalculator(beatmaps)
 ppv2.initialize_calculator(instance)
@@ -1,17 +1,40 @@
 
-from app.common.database.objects import DBBeatmap, DBReplayHistory, DBScore, DBStats
+from app.common.database.objects import DBBeatmap, DBReplayHistory, DBScore, DBStats, DBUser
 from app.common.database import beatmaps, scores, stats, users, histories, beatmapsets
 from app.common.database import usercount as db_usercount
 from app.common.config import config_instance as config
 from app.common.cache import leaderboards, activity
 from app.common.helpers import performance
+from app.weighting import calculate_weighted_pp, calculate_weighted_acc, fetch_weighted_stats, best_score_filters
+from sqlalchemy.orm.attributes import set_committed_value
+from app.writers import BulkRowUpdater
 
+from collections import defaultdict
 from datetime import timedelta
-from sqlalchemy import func
-from typing import List
+from sqlalchemy.orm import Session
+from sqlalchemy import case, func
+from typing import Any, Dict, List, NamedTuple, Tuple
 
 import app.session
 
+GRADE_COLUMNS = {
+    'XH': DBStats.xh_count,
+    'X': DBStats.x_count,
+    'SH': DBStats.sh_count,
+    'S': DBStats.s_count,
+    'A': DBStats.a_count,
+    'B': DBStats.b_count,
+    'C': DBStats.c_count,
+    'D': DBStats.d_count
+}
+
+class ScoreAggregates(NamedTuple):
+    playcount: int
+    playtime: int
+    max_combo: int
+    tscore: int
+    total_hits: int
+
 def update_website_stats() -> None:
     """Update the stats required for the website & api stats"""
     with app.session.database.managed_session() as session:
@@ -58,31 +81,16 @@ def recalculate_stats(user_id: int, mode: int) -> None:
             app.session.logger.warning(f'[stats] -> User "{user_id}" was not found.')
             return
 
-        best_scores_by_score = scores.fetch_best_by_score(
-            user_id,
-            mode,
-            session=session
-        )
+        if not (values := calculate_stats_values(user_id, mode, session)):
+            app.session.logger.warning(f'[stats] -> No scores found for user "{user_id}" in mode "{mode}".')
+            return
 
-        best_scores = scores.fetch_best(
+        stats.update(
             user_id,
             mode,
-            exclude_approved=(not config.APPROVED_MAP_REWARDS),
+            values,
             session=session
         )
-
-        if not (best_scores or best_scores_by_score):
-            app.session.logger.warning(f'[stats] -> No scores found for user "{user_id}" in mode "{mode}".')
-            return
-
-        session.query(DBStats) \
-            .filter(DBStats.user_id == user_id) \
-            .filter(DBStats.mode == mode) \
-            .update({
-                "pp": calculate_weighted_pp(best_scores),
-                "acc": calculate_weighted_acc(best_scores),
-                "rscore": sum(score.total_score for score in best_scores_by_score)
-            })
         session.flush()
 
         user_stats = stats.fetch_by_mode(
@@ -91,10 +99,11 @@ def recalculate_stats(user_id: int, mode: int) -> None:
             session=session
         )
 
-        leaderboards.update(
-            user_stats,
-            player.country.lower()
-        )
+        with app.session.redis.buffered():
+            leaderboards.update(
+                user_stats,
+                player.country.lower()
+            )
 
         user_stats.rank = leaderboards.global_rank(
             user_stats.user_id,
@@ -108,38 +117,136 @@ def recalculate_stats(user_id: int, mode: int) -> None:
                 session=session
             )
 
-        grades = scores.fetch_grades(
-            user_stats.user_id,
-            user_stats.mode,
-            session=session
+        app.session.logger.info(
+            f'[stats] -> Recalculated stats for user "{user_id}" in mode "{mode}".'
         )
 
-        stats.update(
-            user_stats.user_id,
-            user_stats.mode,
-            {
-                f'{grade.lower()}_count': count
-                for grade, count in grades.items()
-            },
-            session=session
-        )
+def calculate_stats_values(
+    user_id: int,
+    mode: int,
+    session: Session,
+    best_scores: List[DBScore] | None = None
+) -> Dict[str, Any] | None:
+    """Calculate pp, acc, ranked score & grade counts of a user, or None if they have no scores"""
+    best_scores_by_score = scores.fetch_best_by_score(
+        user_id,
+        mode,
+        session=session
+    )
+
+    if best_scores is None:
+        best_scores = fetch_best_scores(user_id, mode, session)
+
+    if not (best_scores or best_scores_by_score):
+        return None
+
+    grades = scores.fetch_grades(
+        user_id,
+        mode,
+        session=session
+    )
+
+    return {
+        'pp': calculate_weighted_pp(best_scores),
+        'acc': calculate_weighted_acc(best_scores),
+        'rscore': sum(score.total_score for score in best_scores_by_score),
+        **{
+            column.key: grades.get(grade, 0)
+            for grade, column in GRADE_COLUMNS.items()
+        }
+    }
+
+def fetch_best_scores(user_id: int, mode: int, session: Session) -> List[DBScore]:
+    return scores.fetch_best(
+        user_id,
+        mode,
+        exclude_approved=(not config.APPROVED_MAP_REWARDS),
+        session=session
+    )
+
+def recalculate_stats_all(batch_size: int = 1000) -> None:
+    """Recalculate the stats of all users in all modes"""
+    with app.session.database.managed_session() as session:
+        user_rows = session.query(DBUser.id) \
+            .filter(DBUser.restricted == False) \
+            .order_by(DBUser.id) \
+            .all()
+
+        user_ids = [user_id for (user_id,) in user_rows]
+
+    for index in range(0, len(user_ids), batch_size):
+        recalculate_stats_batch(user_ids[index:index + batch_size])
 
         app.session.logger.info(
-            f'[stats] -> Recalculated stats for user "{user_id}" in mode "{mode}".'
+            f'[stats] -> Progress: {min(index + batch_size, len(user_ids))}/{len(user_ids)} users.'
         )
 
-        del best_scores, best_scores_by_score
+    app.session.logger.info('[stats] -> Done.')
 
-def recalculate_stats_all() -> None:
-    """Recalculate the stats of all users in all modes"""
+def recalculate_stats_batch(user_ids: List[int]) -> None:
+    """Recalculate the stats of multiple users in all modes, using grouped queries"""
     with app.session.database.managed_session() as session:
-        users_entries = users.fetch_all(session=session)
+        stats_values = fetch_stats_values(session, user_ids)
+
+        stats_rows = session.query(DBStats, DBUser.country) \
+            .join(DBUser, DBUser.id == DBStats.user_id) \
+            .filter(DBStats.user_id.in_(user_ids)) \
+            .all()
+
+        updater = BulkRowUpdater(
+            session,
+            (DBStats.user_id, DBStats.mode),
+            (DBStats.pp, DBStats.acc, DBStats.rscore, *GRADE_COLUMNS.values()),
+            batch_size=len(stats_rows) or 1
+        )
+
+        with app.session.redis.buffered() as writer:
+            for user_stats, country in stats_rows:
+                key = (user_stats.user_id, user_stats.mode)
+
+                if not (values := stats_values.get(key)):
+                    # User has not set any scores in this mode
+                    continue
 
-        for user in users_entries:
-            recalculate_stats(user.id, 0)
-            recalculate_stats(user.id, 1)
-            recalculate_stats(user.id, 2)
-            recalculate_stats(user.id, 3)
+                for name, value in values.items():
+                    set_committed_value(user_stats, name, value)
+
+                updater.add(
+                    user_stats.user_id,
+                    user_stats.mode,
+                    *values.values()
+                )
+
+                leaderboards.update(
+                    user_stats,
+                    country.lower()
+                )
+                writer.checkpoint()
+
+        updater.flush()
+
+def fetch_stats_values(session: Session, user_ids: List[int]) -> Dict[Tuple[int, int], Dict[str, Any]]:
+    """Calculate pp, acc, ranked score & grade counts of multiple users in all modes, with three grouped queries"""
+    weighted_stats = fetch_weighted_stats(
+        session,
+        user_ids,
+        exclude_approved=(not config.APPROVED_MAP_REWARDS)
+    )
+    ranked_scores = fetch_ranked_scores(session, user_ids)
+    grade_counts = fetch_grade_counts(session, user_ids)
+
+    return {
+        key: {
+            'pp': weighted_stats[key].pp if key in weighted_stats else 0,
+            'acc': weighted_stats[key].acc if key in weighted_stats else 0,
+            'rscore': ranked_scores.get(key, 0),
+            **{
+                column.key: grade_counts.get(key, {}).get(grade, 0)
+                for grade, column in GRADE_COLUMNS.items()
+            }
+        }
+        for key in weighted_stats.keys() | ranked_scores.keys()
+    }
 
 def restore_stats(user_id: int, remove: bool = False) -> None:
     """Restore the stats of a user, optionally removing existing stats first"""
@@ -161,138 +268,132 @@ def restore_stats(user_id: int, remove: bool = False) -> None:
             for mode in range(4)
         ]
 
-        for mode in range(4):
-            score_count = session.query(DBScore) \
-                .filter(DBScore.user_id == user_id) \
-                .filter(DBScore.mode == mode) \
-                .count()
-
-            fail_times = session.query(
-                func.sum(DBScore.failtime)
-            ) \
-                .filter(DBScore.user_id == user_id) \
-                .filter(DBScore.mode == mode) \
-                .filter(DBScore.status_pp == 1) \
-                .scalar()
-
-            fail_times = (fail_times / 1000) \
-                if fail_times else 0
-
-            map_times = session.query(
-                DBScore,
-                func.sum(DBBeatmap.total_length)
-            ) \
-                .join(DBBeatmap) \
-                .group_by(DBScore) \
-                .filter(DBScore.user_id == 15) \
-                .filter(DBScore.mode == 0) \
-                .filter(DBScore.status_pp > 1) \
-                .first() or [0]
-
-            playtime = map_times[-1] + fail_times
-
-            combo_score = session.query(DBScore) \
-                .filter(DBScore.user_id == user_id) \
-                .filter(DBScore.mode == mode) \
-                .filter(DBScore.hidden == False) \
-                .order_by(DBScore.max_combo.desc()) \
-                .first()
-
-            max_combo = (
-                combo_score.max_combo
-                if combo_score else 0
-            )
+        score_aggregates = fetch_score_aggregates(session, [user_id])
+        replay_views = fetch_replay_views(session, [user_id])
 
-            total_score = session.query(
-                func.sum(DBScore.total_score)
-            ) \
-                .filter(DBScore.user_id == user_id) \
-                .filter(DBScore.hidden == False) \
-                .filter(DBScore.mode == mode) \
-                .scalar() or 0
-
-            user_stats: DBStats = all_stats[mode]
-            user_stats.tscore = int(total_score)
-            user_stats.playcount = score_count
-            user_stats.max_combo = max_combo
-            user_stats.playtime = playtime
-
-            best_scores_by_score = scores.fetch_best_by_score(
-                user_id,
-                mode,
-                session=session
-            )
+        for user_stats in all_stats:
+            key = (user_id, user_stats.mode)
+            aggregates = score_aggregates.get(key)
 
-            best_scores = scores.fetch_best(
-                user_id,
-                mode,
-                exclude_approved=(not config.APPROVED_MAP_REWARDS),
-                session=session
-            )
+            if aggregates:
+                user_stats.playcount = aggregates.playcount
+                user_stats.playtime = aggregates.playtime
+                user_stats.max_combo = aggregates.max_combo
+                user_stats.tscore = aggregates.tscore
+                user_stats.total_hits = aggregates.total_hits
 
-            user_stats.acc = calculate_weighted_acc(best_scores)
-            user_stats.pp = calculate_weighted_pp(best_scores)
-            user_stats.rscore = sum(score.total_score for score in best_scores_by_score)
+            user_stats.replay_views = replay_views.get(key, 0)
 
-            # Update grades
-            grades = scores.fetch_grades(
-                user_stats.user_id,
-                user_stats.mode,
-                session=session
-            )
+            # Best scores are shared between ppv2 & ppv1
+            best_scores = fetch_best_scores(user_id, user_stats.mode, session)
 
-            for grade, count in grades.items():
-                setattr(
-                    user_stats,
-                    f'{grade.lower()}_count',
-                    count
-                )
+            # Update pp, acc, ranked score & grades
+            values = calculate_stats_values(
+                user_id,
+                user_stats.mode,
+                session,
+                best_scores=best_scores
+            ) or {}
 
-            # Update total hits
-            total_hits_formula = {
-                0: DBScore.n50 + DBScore.n100 + DBScore.n300,
-                1: DBScore.n50 + DBScore.n100 + DBScore.n300,
-                2: DBScore.n50 + DBScore.n100 + DBScore.n300 + DBScore.nKatu,
-                3: DBScore.n50 + DBScore.n100 + DBScore.n300 + DBScore.nKatu + DBScore.nGeki
-            }
+            for name, value in values.items():
+                setattr(user_stats, name, value)
 
-            user_stats.total_hits = session.query(
-                func.sum(total_hits_formula[user_stats.mode])
-            ) \
-                .filter(DBScore.user_id == user_stats.user_id) \
-                .filter(DBScore.mode == user_stats.mode) \
-                .filter(DBScore.hidden == False) \
-                .scalar() or 0
-
-            # Update replay views
-            user_stats.replay_views = session.query(
-                func.sum(DBReplayHistory.replay_views)
-            ) \
-                .filter(DBReplayHistory.user_id == user_stats.user_id) \
-                .filter(DBReplayHistory.mode == user_stats.mode) \
-                .scalar() or 0
-            
             user_stats.ppv1 = performance.calculate_weighted_ppv1(
                 best_scores,
                 session=session
             )
 
-        for user_stats in all_stats:
-            session.add(user_stats)
-            leaderboards.update(user_stats, user.country)
-
-def calculate_weighted_pp(scores: List[DBScore]) -> float:
-    if not scores:
-        return 0
-
-    weighted_pp = sum(score.pp * 0.95**index for index, score in enumerate(scores))
-    bonus_pp = 416.6667 * (1 - 0.9994 ** len(scores))
-    return weighted_pp + bonus_pp
-
-def calculate_weighted_acc(scores: List[DBScore]) -> float:
-    if not scores:
-        return 0
-
-    weighted_acc = sum(score.acc * 0.95**index for index, score in enumerate(scores))
-    bonus_acc = 100.0 / (20 * (1 - 0.95 ** len(scores)))
-    return (weighted_acc * bonus_acc) / 100
+        with app.session.redis.buffered():
+            for user_stats in all_stats:
+                session.add(user_stats)
+                leaderboards.update(user_stats, user.country)
+
+def fetch_score_aggregates(session: Session, user_ids: List[int]) -> Dict[Tuple[int, int], ScoreAggregates]:
+    """Aggregate the score-based stats of multiple users in all modes, with a single query"""
+    visible = DBScore.hidden == False
+
+    # Katu & geki hits only count towards total hits in ctb & mania
+    total_hits = DBScore.n50 + DBScore.n100 + DBScore.n300 + case(
+        (DBScore.mode == 2, DBScore.nKatu),
+        (DBScore.mode == 3, DBScore.nKatu + DBScore.nGeki),
+        else_=0
+    )
+
+    rows = session.query(
+        DBScore.user_id,
+        DBScore.mode,
+        func.count(DBScore.id),
+        func.coalesce(func.sum(DBScore.failtime).filter(DBScore.status_pp == 1), 0),
+        func.coalesce(func.sum(DBBeatmap.total_length).filter(DBScore.status_pp > 1), 0),
+        func.coalesce(func.max(DBScore.max_combo).filter(visible), 0),
+        func.coalesce(func.sum(DBScore.total_score).filter(visible), 0),
+        func.coalesce(func.sum(total_hits).filter(visible), 0)
+    ) \
+        .outerjoin(DBBeatmap, DBBeatmap.id == DBScore.beatmap_id) \
+        .filter(DBScore.user_id.in_(user_ids)) \
+        .group_by(DBScore.user_id, DBScore.mode) \
+        .all()
+
+    return {
+        (user_id, mode): ScoreAggregates(
+            playcount=playcount,
+            playtime=int(map_times + fail_times / 1000),
+            max_combo=max_combo,
+            tscore=int(tscore),
+            total_hits=int(total_hits)
+        )
+        for user_id, mode, playcount, fail_times, map_times, max_combo, tscore, total_hits in rows
+    }
+
+def fetch_replay_views(session: Session, user_ids: List[int]) -> Dict[Tuple[int, int], int]:
+    rows = session.query(
+        DBReplayHistory.user_id,
+        DBReplayHistory.mode,
+        func.sum(DBReplayHistory.replay_views)
+    ) \
+        .filter(DBReplayHistory.user_id.in_(user_ids)) \
+        .group_by(DBReplayHistory.user_id, DBReplayHistory.mode) \
+        .all()
+
+    return {
+        (user_id, mode): int(views or 0)
+        for user_id, mode, views in rows
+    }
+
+def fetch_ranked_scores(session: Session, user_ids: List[int]) -> Dict[Tuple[int, int], int]:
+    rows = session.query(
+        DBScore.user_id,
+        DBScore.mode,
+        func.sum(DBScore.total_score)
+    ) \
+        .join(DBBeatmap, DBBeatmap.id == DBScore.beatmap_id) \
+        .filter(DBScore.user_id.in_(user_ids)) \
+        .filter(*best_score_filters(DBScore.status_score)) \
+        .group_by(DBScore.user_id, DBScore.mode) \
+        .all()
+
+    return {
+        (user_id, mode): int(rscore)
+        for user_id, mode, rscore in rows
+    }
+
+def fetch_grade_counts(session: Session, user_ids: List[int]) -> Dict[Tuple[int, int], Dict[str, int]]:
+    rows = session.query(
+        DBScore.user_id,
+        DBScore.mode,
+        DBScore.grade,
+        func.count()
+    ) \
+        .join(DBBeatmap, DBBeatmap.id == DBScore.beatmap_id) \
+        .filter(DBScore.user_id.in_(user_ids)) \
+        .filter(*best_score_filters(DBScore.status_score)) \
+        .group_by(DBScore.user_id, DBScore.mode, DBScore.grade) \
+        .all()
+
+    grade_counts = defaultdict(dict)
+
+    for user_id, mode, grade, count in rows:
+        if grade:
+            grade_counts[(user_id, mode)][grade.upper()] = count
+
+    return grade_counts
@@ -0,0 +1,102 @@
+
+from app.common.database.objects import DBScore
+from sqlalchemy.orm import InstrumentedAttribute, Session
+from typing import Any, Iterator, List, Tuple
+
+def iterate_rows(
+    session: Session,
+    model: Any,
+    *criteria,
+    batch_size: int = 1000,
+    min_id: int = 0,
+    max_id: int | None = None
+) -> Iterator[List[Any]]:
+    """Iterate over all rows of a model matching the criteria in id-ordered batches"""
+    last_id = min_id - 1
+
+    while True:
+        query = session.query(model) \
+            .filter(model.id > last_id) \
+            .filter(*criteria)
+
+        if max_id is not None:
+            query = query.filter(model.id <= max_id)
+
+        batch = query \
+            .order_by(model.id) \
+            .limit(batch_size) \
+            .all()
+
+        if not batch:
+            break
+
+        # Resolve the next keyset position before the
+        # caller gets a chance to commit & expire the batch
+        last_id = batch[-1].id
+        yield batch
+
+        if len(batch) < batch_size:
+            break
+
+def iterate_id_ranges(
+    session: Session,
+    id_column: InstrumentedAttribute,
+    *criteria,
+    range_size: int = 1000,
+    min_id: int = 0
+) -> Iterator[Tuple[int, int]]:
+    """Split the ids of all matching rows into (first_id, last_id) ranges"""
+    query = session.query(id_column) \
+        .filter(id_column >= min_id) \
+        .filter(*criteria) \
+        .order_by(id_column) \
+        .yield_per(range_size)
+
+    range_start = None
+    range_end = None
+    range_count = 0
+
+    for (row_id,) in query:
+        if range_start is None:
+            range_start = row_id
+
+        range_end = row_id
+        range_count += 1
+
+        if range_count >= range_size:
+            yield range_start, range_end
+            range_start = None
+            range_count = 0
+
+    if range_start is not None:
+        yield range_start, range_end
+
+def iterate_scores(
+    session: Session,
+    *criteria,
+    batch_size: int = 1000,
+    min_id: int = 0,
+    max_id: int | None = None
+) -> Iterator[List[DBScore]]:
+    """Iterate over all scores matching the criteria in id-ordered batches"""
+    return iterate_rows(
+        session,
+        DBScore,
+        *criteria,
+        batch_size=batch_size,
+        min_id=min_id,
+        max_id=max_id
+    )
+
+def iterate_score_ranges(
+    session: Session,
+    *criteria,
+    range_size: int = 1000
+) -> Iterator[Tuple[int, int]]:
+    """Split the ids of all matching scores into (first_id, last_id) ranges"""
+    return iterate_id_ranges(
+        session,
+        DBScore.id,
+        *criteria,
+        range_size=range_size
+    )
@@ -1,11 +1,12 @@
 
-from app.common.database.objects import DBReplayHistory, DBPlayHistory, DBScore
-from app.common.database import users, histories
+from app.common.database.objects import DBReplayHistory, DBPlayHistory, DBScore, DBUser
+from app.common.database import users
 from app.common.cache import leaderboards
 
-from dateutil.relativedelta import relativedelta
-from collections import defaultdict
-from datetime import datetime
+from sqlalchemy import Integer, cast, extract, func, insert, literal, select
+from sqlalchemy.orm import InstrumentedAttribute, Session
+from app import streaming, watermarks
+from typing import Any
 
 import hashlib
 import app
@@ -24,125 +25,157 @@ def change_country(user_id: int, new_country: str) -> None:
         user.stats.sort(key=lambda x: x.mode)
         old_country = user.country
 
-        leaderboards.remove_country(
-            user.id,
-            old_country
-        )
-
         users.update(user.id, {'country': new_country}, session=session)
         user.country = new_country
 
-        for mode in range(4):
-            leaderboards.update(
-                user.stats[mode],
-                user.country
+        with app.session.redis.buffered():
+            leaderboards.remove_country(
+                user.id,
+                old_country
             )
 
-    app.session.logger.info(f'[users] -> Done.')
+            for mode in range(4):
+                leaderboards.update(
+                    user.stats[mode],
+                    user.country
+                )
 
-def fix_historical_data() -> None:
-    for user in users.fetch_all():
-        for mode in range(4):
-            fix_replay_history_for_user(user.id, mode)
-            fix_play_history_for_user(user.id, mode)
+    app.session.logger.info(f'[users] -> Done.')
 
-def fix_historical_data_for_user(user_id: int) -> None:
-    for mode in range(4):
-        fix_replay_history_for_user(user_id, mode)
-        fix_play_history_for_user(user_id, mode)
+def fix_historical_data(full: bool = False) -> None:
+    """Fill in missing months in the replay history of all users & the play history of all recently active users"""
+    # Without a previous run, every user has to be checked anyway
+    full = full or watermarks.last_run('historical_data') is None
 
-def fix_replay_history_for_user(user_id: int, mode: int) -> None:
-    """Ensure that there are no missing entries in the user's replay history"""
     with app.session.database.managed_session() as session:
-        if not (user := users.fetch_by_id(user_id, session=session)):
-            app.session.logger.warning(f'[users] -> User "{user_id}" was not found.')
-            return
-
-        app.session.logger.info(f'[users] -> Fixing replay history data for user "{user.name}"...')
-        all_replay_entries = histories.fetch_replay_history_all(user.id, mode, session=session)
-        all_replay_entries.sort(key=lambda x: (x.year, x.month))
-
-        if not all_replay_entries:
-            app.session.logger.warning(f'[users] -> No replay history found for user "{user.name}".')
-            return
-
-        last_entry: DBReplayHistory = all_replay_entries[0]
+        # Replay views from other players don't update the activity of the
+        # replay's owner, so the replay history of every user is checked
+        fix_history_gaps(session, DBReplayHistory, DBReplayHistory.replay_views)
 
-        for entry in all_replay_entries[1:]:
-            last_entry_date = datetime(year=last_entry.year, month=last_entry.month, day=1)
-            this_entry_date = datetime(year=entry.year, month=entry.month, day=1)
+        with watermarks.active_users('historical_data', session, full) as user_ids:
+            if not user_ids:
+                return
 
-            # If the gap is more than 1 month, fill in missing months
-            while last_entry_date + relativedelta(months=1) < this_entry_date:
-                last_entry_date += relativedelta(months=1)
+            criteria = [] if full else [DBUser.id.in_(user_ids)]
+            fix_history_gaps(session, DBPlayHistory, DBPlayHistory.plays, *criteria)
 
-                # Create a new empty replay entry
-                missing_entry = DBReplayHistory(user.id, mode)
-                missing_entry.year = last_entry_date.year
-                missing_entry.month = last_entry_date.month
-                missing_entry.created_at = datetime(
-                    year=last_entry_date.year,
-                    month=last_entry_date.month,
-                    day=1
-                )
-                session.add(missing_entry)
-
-                app.session.logger.info(
-                    f"[users] -> Added missing replay history entry for "
-                    f"'{user.name}' ({last_entry_date.year}-{last_entry_date.month:02d})"
-                )
+def fix_historical_data_for_user(user_id: int) -> None:
+    with app.session.database.managed_session() as session:
+        fix_history_gaps(session, DBReplayHistory, DBReplayHistory.replay_views, DBUser.id == user_id)
+        fix_history_gaps(session, DBPlayHistory, DBPlayHistory.plays, DBUser.id == user_id)
 
-            session.flush()
-            last_entry = entry
+def fix_replay_history_for_user(user_id: int, mode: int) -> None:
+    """Ensure that there are no missing entries in the user's replay history"""
+    with app.session.database.managed_session() as session:
+        fix_history_gaps(
+            session,
+            DBReplayHistory,
+            DBReplayHistory.replay_views,
+            DBUser.id == user_id,
+            DBReplayHistory.mode == mode
+        )
 
 def fix_play_history_for_user(user_id: int, mode: int) -> None:
     """Ensure that there are no missing entries in the user's play history"""
     with app.session.database.managed_session() as session:
-        if not (user := users.fetch_by_id(user_id, session=session)):
-            app.session.logger.warning(f'[users] -> User "{user_id}" was not found.')
-            return
-
-        app.session.logger.info(f'[users] -> Fixing play history data for user "{user.name}"...')
-        all_play_entries = histories.fetch_plays_history_all(user.id, mode, session=session)
-        all_play_entries.sort(key=lambda x: (x.year, x.month))
-
-        if not all_play_entries:
-            app.session.logger.warning(f'[users] -> No play history found for user "{user.name}".')
-            return
+        fix_history_gaps(
+            session,
+            DBPlayHistory,
+            DBPlayHistory.plays,
+            DBUser.id == user_id,
+            DBPlayHistory.mode == mode
+        )
 
-        last_entry: DBPlayHistory = all_play_entries[0]
+def fix_history_gaps(session: Session, model: Any, count_column: InstrumentedAttribute, *criteria) -> int:
+    """Insert empty entries for all missing months between the first & last entry of each user"""
+    gaps = history_gaps(session, model, *criteria)
+
+    if not session.scalar(select(gaps.c.user_id).exists().select()):
+        app.session.logger.info(f'[users] -> No gaps found in {model.__tablename__}.')
+        return 0
+
+    month_index = func.generate_series(gaps.c.first_month, gaps.c.last_month, type_=Integer) \
+        .column_valued('month_index')
+
+    candidates = select(
+        gaps.c.user_id,
+        gaps.c.mode,
+        (month_index // 12).label('year'),
+        (month_index % 12 + 1).label('month')
+    ) \
+        .subquery('candidates')
+
+    existing_entries = select(model.user_id) \
+        .where(model.user_id == candidates.c.user_id) \
+        .where(model.mode == candidates.c.mode) \
+        .where(model.year == candidates.c.year) \
+        .where(model.month == candidates.c.month) \
+        .exists()
+
+    missing_entries = select(
+        candidates.c.user_id,
+        candidates.c.mode,
+        candidates.c.year,
+        candidates.c.month,
+        literal(0),
+        func.make_date(candidates.c.year, candidates.c.month, 1)
+    ) \
+        .where(~existing_entries)
+
+    statement = insert(model).from_select(
+        (
+            model.user_id,
+            model.mode,
+            model.year,
+            model.month,
+            count_column,
+            model.created_at
+        ),
+        missing_entries
+    )
+
+    inserted = session.execute(statement).rowcount
+    app.session.logger.info(f'[users] -> Added {inserted} missing entries to {model.__tablename__}.')
+    return inserted
+
+def history_gaps(session: Session, model: Any, *criteria):
+    """Build a subquery of all (user_id, mode) pairs, whose history has at least one missing month"""
+    month_index = model.year * 12 + model.month - 1
+
+    # Entries are unique per month, so any history with fewer
+    # entries than months between its bounds must have a gap
+    return session.query(
+        model.user_id,
+        model.mode,
+        func.min(month_index).label('first_month'),
+        func.max(month_index).label('last_month')
+    ) \
+        .join(DBUser, DBUser.id == model.user_id) \
+        .filter(*criteria) \
+        .group_by(model.user_id, model.mode) \
+        .having(func.max(month_index) - func.min(month_index) + 1 > func.count()) \
+        .subquery('gaps')
+
+def recreate_play_history(batch_size: int = 1000) -> None:
+    """Recreate the play history of all users from their plays"""
+    with app.session.database.managed_session() as session:
+        user_ranges = list(streaming.iterate_id_ranges(
+            session,
+            DBUser.id,
+            range_size=int(batch_size)
+        ))
 
-        for entry in all_play_entries[1:]:
-            last_entry_date = datetime(year=last_entry.year, month=last_entry.month, day=1)
-            this_entry_date = datetime(year=entry.year, month=entry.month, day=1)
+        app.session.logger.info(f'[users] -> Recreating play history ({len(user_ranges)} ranges)...')
 
-            # If the gap is more than 1 month, fill in missing months
-            while last_entry_date + relativedelta(months=1) < this_entry_date:
-                last_entry_date += relativedelta(months=1)
+        for min_id, max_id in user_ranges:
+            entries = rebuild_play_history(session, min_id, max_id)
+            session.commit()
 
-                # Create a new empty play entry
-                missing_entry = DBPlayHistory(user.id, mode)
-                missing_entry.year = last_entry_date.year
-                missing_entry.month = last_entry_date.month
-                missing_entry.created_at = datetime(
-                    year=last_entry_date.year,
-                    month=last_entry_date.month,
-                    day=1
-                )
-                session.add(missing_entry)
-                session.flush()
-
-                app.session.logger.info(
-                    f"[users] -> Added missing play history entry for "
-                    f"'{user.name}' ({last_entry_date.year}-{last_entry_date.month:02d})"
-                )
-
-            last_entry = entry
+            app.session.logger.info(
+                f'[users] -> Recreated {entries} play history entries ({min_id}-{max_id})'
+            )
 
-def recreate_play_history() -> None:
-    for user in users.fetch_all():
-        for mode in range(4):
-            recreate_play_history_for_user(user.id, mode)
+    app.session.logger.info(f'[users] -> Done.')
 
 def recreate_play_history_for_user(user_id: int, mode: int) -> None:
     """Recreate the play history for a user from their plays"""
@@ -152,30 +185,52 @@ def recreate_play_history_for_user(user_id: int, mode: int) -> None:
             return
 
         app.session.logger.info(f'[users] -> Recreating play history for user "{user.name}" ({mode})...')
-        entries: dict[tuple[int, int], int] = defaultdict(int)
-
-        score_timestamps = session.query(DBScore.submitted_at) \
-            .filter(DBScore.hidden == False) \
-            .filter(DBScore.user_id == user.id) \
-            .filter(DBScore.mode == mode) \
-            .all()
-
-        for (submitted_at,) in score_timestamps:
-            year = submitted_at.year
-            month = submitted_at.month
-            entries[(year, month)] += 1
-
-        # Clear existing play history for this user and mode
-        session.query(DBPlayHistory) \
-            .filter(DBPlayHistory.user_id == user.id) \
-            .filter(DBPlayHistory.mode == mode) \
-            .delete()
-
-        for (year, month), play_count in entries.items():
-            entry = DBPlayHistory(user.id, mode, play_count)
-            entry.created_at = datetime(year=year, month=month, day=1)
-            entry.year = year
-            entry.month = month
-            session.add(entry)
+        rebuild_play_history(session, user.id, user.id, mode)
 
     app.session.logger.info(f'[users] -> Done.')
+
+def rebuild_play_history(session: Session, min_user_id: int, max_user_id: int, mode: int | None = None) -> int:
+    """Replace the play history of a range of users with monthly play counts, using a single INSERT ... SELECT"""
+    delete_query = session.query(DBPlayHistory) \
+        .filter(DBPlayHistory.user_id.between(min_user_id, max_user_id))
+
+    score_query = session.query(
+        DBScore.user_id,
+        DBScore.mode,
+        func.date_trunc('month', DBScore.submitted_at).label('month')
+    ) \
+        .filter(DBScore.hidden == False) \
+        .filter(DBScore.user_id.between(min_user_id, max_user_id))
+
+    if mode is not None:
+        delete_query = delete_query.filter(DBPlayHistory.mode == mode)
+        score_query = score_query.filter(DBScore.mode == mode)
+
+    delete_query.delete(synchronize_session=False)
+
+    score_months = score_query.subquery()
+    month = score_months.c.month
+
+    entries = select(
+        score_months.c.user_id,
+        score_months.c.mode,
+        cast(extract('year', month), Integer),
+        cast(extract('month', month), Integer),
+        func.count(),
+        month
+    ) \
+        .group_by(score_months.c.user_id, score_months.c.mode, month)
+
+    statement = insert(DBPlayHistory).from_select(
+        (
+            DBPlayHistory.user_id,
+            DBPlayHistory.mode,
+            DBPlayHistory.year,
+            DBPlayHistory.month,
+            DBPlayHistory.plays,
+            DBPlayHistory.created_at
+        ),
+        entries
+    )
+
+    return session.execute(statement).rowcount
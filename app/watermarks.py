@@ -0,0 +1,46 @@
+
+from app.common.database.objects import DBUser
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy.orm import Session
+from typing import Iterator, List
+
+import app.session
+
+# Users that were active shortly before the last run
+# may not have been fully processed by that run
+safety_margin = timedelta(minutes=10)
+
+def watermark_key(task_name: str) -> str:
+    return f'bancho:jobs:{task_name}:last_run'
+
+def last_run(task_name: str) -> datetime | None:
+    """Get the time of the last successful run of a task"""
+    if not (timestamp := app.session.redis.get(watermark_key(task_name))):
+        return None
+
+    return datetime.fromtimestamp(float(timestamp))
+
+@contextmanager
+def active_users(task_name: str, session: Session, full: bool = False) -> Iterator[List[int]]:
+    """Yield the ids of all users that were active since the last successful run of a task"""
+    started_at = datetime.now()
+    previous_run = last_run(task_name)
+
+    query = session.query(DBUser.id) \
+        .filter(DBUser.restricted == False)
+
+    if previous_run and not full:
+        since = previous_run - safety_margin
+        query = query.filter(DBUser.latest_activity >= since)
+
+    user_ids = [user_id for (user_id,) in query.all()]
+
+    app.session.logger.info(
+        f'[{task_name}] -> Found {len(user_ids)} users to process.'
+    )
+
+    yield user_ids
+
+    # Only advance the watermark if the task did not fail
+    app.session.redis.set(watermark_key(task_name), started_at.timestamp())
@@ -0,0 +1,106 @@
+
+from app.common.database.objects import DBBeatmap, DBScore
+from app.common.constants import BeatmapStatus
+from sqlalchemy.orm import InstrumentedAttribute, Session
+from sqlalchemy import func
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+import math
+
+# Precomputed 0.95^n weights, grown on demand
+weight_table: List[float] = [0.95 ** index for index in range(1000)]
+
+class WeightedStats(NamedTuple):
+    pp: float
+    acc: float
+    count: int
+
+def weights(amount: int) -> List[float]:
+    while len(weight_table) < amount:
+        weight_table.append(0.95 ** len(weight_table))
+
+    return weight_table[:amount]
+
+def calculate_weighted_pp(scores: List[DBScore]) -> float:
+    if not scores:
+        return 0
+
+    weighted_pp = math.sumprod((score.pp for score in scores), weights(len(scores)))
+    return weighted_pp + bonus_pp(len(scores))
+
+def calculate_weighted_acc(scores: List[DBScore]) -> float:
+    if not scores:
+        return 0
+
+    weighted_acc = math.sumprod((score.acc for score in scores), weights(len(scores)))
+    return (weighted_acc * bonus_acc(len(scores))) / 100
+
+def bonus_pp(score_count: int) -> float:
+    return 416.6667 * (1 - 0.9994 ** score_count)
+
+def bonus_acc(score_count: int) -> float:
+    return 100.0 / (20 * (1 - 0.95 ** score_count))
+
+def best_score_filters(status_column: InstrumentedAttribute, exclude_approved: bool = False) -> list:
+    """Filters that select the best scores of a user, requires a join on DBBeatmap"""
+    filters = [
+        status_column == 3,
+        DBScore.hidden == False,
+        DBBeatmap.status > BeatmapStatus.Pending.value
+    ]
+
+    if exclude_approved:
+        filters.append(
+            DBBeatmap.status.notin_((
+                BeatmapStatus.Approved.value,
+                BeatmapStatus.Loved.value
+            ))
+        )
+
+    return filters
+
+def fetch_weighted_stats(
+    session: Session,
+    user_ids: Iterable[int] | None = None,
+    exclude_approved: bool = False
+) -> Dict[Tuple[int, int], WeightedStats]:
+    """Calculate weighted pp & acc of many users in all modes, with a single query"""
+    index = func.row_number().over(
+        partition_by=(DBScore.user_id, DBScore.mode),
+        order_by=(DBScore.pp.desc(), DBScore.id)
+    )
+
+    ranked_scores = session.query(
+        DBScore.user_id,
+        DBScore.mode,
+        DBScore.pp,
+        DBScore.acc,
+        index.label('index')
+    ) \
+        .join(DBBeatmap, DBBeatmap.id == DBScore.beatmap_id) \
+        .filter(*best_score_filters(DBScore.status_pp, exclude_approved))
+
+    if user_ids is not None:
+        ranked_scores = ranked_scores.filter(DBScore.user_id.in_(list(user_ids)))
+
+    ranked_scores = ranked_scores.subquery()
+    weight = func.power(0.95, ranked_scores.c.index - 1)
+
+    rows = session.query(
+        ranked_scores.c.user_id,
+        ranked_scores.c.mode,
+        func.sum(ranked_scores.c.pp * weight),
+        func.sum(ranked_scores.c.acc * weight),
+        func.count()
+    ) \
+        .group_by(ranked_scores.c.user_id, ranked_scores.c.mode) \
+        .all()
+
+    return {
+        (user_id, mode): WeightedStats(
+            pp=float(weighted_pp) + bonus_pp(count),
+            acc=(float(weighted_acc) * bonus_acc(count)) / 100,
+            count=count
+        )
+        for user_id, mode, weighted_pp, weighted_acc, count in rows
+    }
@@ -0,0 +1,85 @@
+
+from sqlalchemy import and_, cast, column, update, values
+from sqlalchemy.orm import InstrumentedAttribute, Session
+from typing import Any, List, Sequence, Tuple
+
+class BulkRowUpdater:
+    """Collect rows of (*keys, *values) and write them in batches"""
+
+    def __init__(
+        self,
+        session: Session,
+        keys: Sequence[InstrumentedAttribute],
+        targets: Sequence[InstrumentedAttribute],
+        batch_size: int = 1000
+    ) -> None:
+        self.session = session
+        self.keys = tuple(keys)
+        self.targets = tuple(targets)
+        self.model = self.keys[0].class_
+        self.batch_size = max(1, batch_size)
+        self.pending: List[Tuple[Any, ...]] = []
+        self.total = 0
+
+    def __enter__(self) -> "BulkRowUpdater":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.flush()
+
+    def add(self, *row: Any) -> None:
+        self.pending.append(row)
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> int:
+        """Write all pending rows with a single UPDATE ... FROM (VALUES ...) statement"""
+        if not self.pending:
+            return 0
+
+        updates = values(
+            *(
+                column(attribute.key, attribute.type)
+                for attribute in self.keys + self.targets
+            ),
+            name='updates'
+        ).data(self.pending)
+
+        # Values are sent as untyped literals, which postgres would
+        # resolve to text for columns that only contain NULLs
+        typed = {
+            attribute.key: cast(updates.c[attribute.key], attribute.type)
+            for attribute in self.keys + self.targets
+        }
+
+        statement = update(self.model) \
+            .where(and_(*(key == typed[key.key] for key in self.keys))) \
+            .values({target: typed[target.key] for target in self.targets}) \
+            .execution_options(synchronize_session=False)
+
+        self.session.execute(statement)
+        count = len(self.pending)
+        self.total += count
+        self.pending.clear()
+        return count
+
+class BulkUpdater(BulkRowUpdater):
+    """Collect (id, value) pairs for a single column and write them in batches"""
+
+    def __init__(
+        self,
+        session: Session,
+        target: InstrumentedAttribute,
+        batch_size: int = 1000
+    ) -> None:
+        super().__init__(
+            session,
+            (target.class_.id,),
+            (target,),
+            batch_size
+        )
+
+    def add(self, id: int, value: Any) -> None:
+        super().add(id, value)